@@ -0,0 +1,265 @@
+#! /usr/bin/env python
+'''
+Measures the scheduling cost of the dispatcher on a synthetic farm.
+
+The dispatcher is run in memory, without database nor http: the pools, rendernodes
+and graphs are generated from the command line options, the requests to the
+rendernodes are stubbed, and the main loop is driven for a given number of cycles.
+The results are written as JSON.
+'''
+
+import json
+import logging
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from octopus.dispatcher import settings
+
+
+def process_args():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--pools", action="store", type="int", dest="pools", default=1, help="number of pools")
+    parser.add_option("--rendernodes", action="store", type="int", dest="rendernodes", default=100, help="number of rendernodes, spread over the pools")
+    parser.add_option("--cores", action="store", type="int", dest="cores", default=8, help="number of cores of each rendernode")
+    parser.add_option("--ram", action="store", type="int", dest="ram", default=16000, help="ram size of each rendernode")
+    parser.add_option("--users", action="store", type="int", dest="users", default=10, help="number of users submitting the graphs")
+    parser.add_option("--graphs", action="store", type="int", dest="graphs", default=20, help="number of graphs")
+    parser.add_option("--tasks", action="store", type="int", dest="tasks", default=5, help="number of tasks per graph")
+    parser.add_option("--commands", action="store", type="int", dest="commands", default=100, help="number of commands per task")
+    parser.add_option("--dependencies", action="store_true", dest="dependencies", default=False, help="make each task of a graph depend on the previous one")
+    parser.add_option("--task-cores", action="store", type="int", dest="taskCores", default=0, help="number of cores used by each command (0 for the whole rendernode)")
+    parser.add_option("--task-ram", action="store", type="int", dest="taskRam", default=0, help="ram used by each command")
+    parser.add_option("--packing", action="store_true", dest="packing", default=False, help="let the rendernodes run several commands at once")
+    parser.add_option("--frames", action="store", type="int", dest="frames", default=1, help="number of frames of each command, a command runs for one cycle per frame")
+    parser.add_option("--short-ratio", action="store", type="float", dest="shortRatio", default=0.0, help="ratio of the tasks of each graph whose commands have a single frame")
+    parser.add_option("--strategy", action="store", type="string", dest="strategy", default="octopus.dispatcher.strategies.FifoStrategy", help="strategy of the graphs, ordering their tasks")
+    parser.add_option("--licenses", action="store", type="int", dest="licenses", default=0, help="number of licenses required by one task out of two (0 to disable)")
+    parser.add_option("--cycles", action="store", type="int", dest="cycles", default=50, help="number of dispatcher cycles to run")
+    parser.add_option("--finish-ratio", action="store", type="float", dest="finishRatio", default=1.0, help="ratio of the running commands completed after each cycle")
+    parser.add_option("-o", "--output", action="store", type="string", dest="output", metavar="FILE", help="write the results to FILE instead of the standard output")
+    parser.add_option("-D", "--debug", action="store_true", dest="DEBUG", default=False, help="output the dispatcher logs to the console")
+    options, args = parser.parse_args()
+    return options
+
+
+def setup_settings(confdir, options):
+    os.mkdir(os.path.join(confdir, "pools"))
+    open(os.path.join(confdir, "workers.lst"), "w").close()
+    with open(os.path.join(confdir, "licences.lst"), "w") as f:
+        if options.licenses:
+            f.write("bench %d\n" % options.licenses)
+    settings.DB_ENABLE = False
+    settings.POOLS_BACKEND_TYPE = "file"
+    settings.FILE_BACKEND_RN_PATH = os.path.join(confdir, "workers.lst")
+    settings.FILE_BACKEND_LICENCES_PATH = os.path.join(confdir, "licences.lst")
+    settings.FILE_BACKEND_POOL_PATH = os.path.join(confdir, "pools")
+    settings.RENDERNODE_REQUEST_DELAY_AFTER_REQUEST_FAILURE = 0
+    settings.MIN_CYCLE_PERIOD = 0
+    settings.MAX_CYCLE_PERIOD = 0
+    settings.RENDERNODE_PACKING = options.packing
+    # a frame runs for one cycle, that is one second of the simulated clock of the commands
+    settings.RUNNER_TIME_BY_FRAME = {'bench': 1000.0}
+
+
+class StubResponse(object):
+    status = 202
+    reason = "Accepted"
+    length = 0
+
+    def read(self, *args):
+        return ""
+
+    def getheader(self, name, default=None):
+        return default
+
+
+def stubRequest(rendernode, method, url, body=None, headers={}):
+    if url == "/commands/batch/":
+        results = [{'id': command['id'], 'status': 'accepted'} for command in json.loads(body)['commands']]
+        return StubResponse(), json.dumps({'commands': results})
+    return StubResponse(), None
+
+
+class SimulatedClock(object):
+    '''Replaces the time module in the command model, so that the times by frame are measured in cycles.'''
+
+    def __init__(self):
+        self.cycle = 0
+
+    def time(self):
+        return float(self.cycle)
+
+
+def timed(timings, name, func):
+    def timedFunc(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[name].append(time.time() - start)
+    return timedFunc
+
+
+def isShortTask(options, taskIndex):
+    # spread the short tasks evenly among the others
+    return int((taskIndex + 1) * options.shortRatio) != int(taskIndex * options.shortRatio)
+
+
+def makeGraph(options, index, poolName):
+    taskDefs = []
+    for taskIndex in xrange(options.tasks):
+        frames = 1 if isShortTask(options, taskIndex) else options.frames
+        dependencies = []
+        if options.dependencies and taskIndex:
+            # the root taskgroup is the first element of the list, the previous task is at taskIndex
+            dependencies = [[taskIndex, [3]]]
+        taskDefs.append({
+            'type': 'Task', 'name': 'task%d' % taskIndex, 'runner': 'bench', 'arguments': {}, 'environment': {},
+            'requirements': {}, 'maxRN': 0, 'priority': 0, 'dispatchKey': 0, 'validationExpression': 'VAL_TRUE',
+            'minNbCores': 0, 'maxNbCores': options.taskCores, 'ramUse': options.taskRam, 'tags': {}, 'dependencies': dependencies,
+            'lic': 'bench' if options.licenses and taskIndex % 2 == 0 else '',
+            'commands': [{'description': 'cmd_%d_%d' % (i * frames, (i + 1) * frames - 1), 'arguments': {}} for i in xrange(options.commands)],
+        })
+    taskGroupDef = {
+        'type': 'TaskGroup', 'name': 'graph%d' % index, 'arguments': {}, 'environment': {}, 'requirements': {},
+        'maxRN': 0, 'priority': 0, 'dispatchKey': 0, 'strategy': options.strategy,
+        'tags': {}, 'dependencies': [], 'tasks': range(1, options.tasks + 1),
+    }
+    return {'name': 'graph%d' % index, 'user': 'user%d' % (index % options.users), 'poolName': poolName,
+            'root': 0, 'tasks': [taskGroupDef] + taskDefs}
+
+
+def summarize(values):
+    if not values:
+        return {'count': 0, 'total': 0.0, 'mean': 0.0, 'max': 0.0}
+    return {'count': len(values), 'total': sum(values), 'mean': float(sum(values)) / len(values), 'max': max(values)}
+
+
+def run(options):
+    from octopus.dispatcher.dispatcher import Dispatcher
+    from octopus.dispatcher.model import Pool, RenderNode
+    from octopus.dispatcher.model import command as commandModel
+    from octopus.core.enums.command import CMD_ASSIGNED, CMD_RUNNING, CMD_DONE
+    from octopus.core.enums.rendernode import RN_IDLE
+    from octopus.core.tools import Workload
+
+    RenderNode.request = stubRequest
+    clock = commandModel.time = SimulatedClock()
+
+    setupStart = time.time()
+    dispatcher = Dispatcher(None)
+    tree = dispatcher.dispatchTree
+    pools = [tree.pools['default']]
+    for index in xrange(1, options.pools):
+        pools.append(Pool(None, "pool%d" % index))
+    rendernodes = []
+    for index in xrange(options.rendernodes):
+        rendernode = RenderNode(None, "rn%d:8000" % index, options.cores, 3.0, "127.0.0.1", 8000, options.ram, {})
+        rendernode.performance = float(index % 5)
+        pools[index % len(pools)].addRenderNode(rendernode)
+        tree.renderNodes[rendernode.name] = rendernode
+        rendernode.isRegistered = True
+        rendernode.lastAliveTime = time.time()
+        rendernode.status = RN_IDLE
+        rendernodes.append(rendernode)
+    for index in xrange(options.graphs):
+        dispatcher.handleNewGraphRequestApply(makeGraph(options, index, pools[index % len(pools)].name))
+    setupDuration = time.time() - setupStart
+
+    timings = defaultdict(list)
+    tree.updateCompletionAndStatus = timed(timings, "updateCompletionAndStatus", tree.updateCompletionAndStatus)
+    tree.validateDependencies = timed(timings, "validateDependencies", tree.validateDependencies)
+    dispatcher.updateRenderNodes = timed(timings, "updateRenderNodes", dispatcher.updateRenderNodes)
+    dispatcher.updateDB = timed(timings, "updateDB", dispatcher.updateDB)
+    dispatcher.sendAssignments = timed(timings, "sendAssignments", dispatcher.sendAssignments)
+    computeAssignments = dispatcher.computeAssignments
+    # number of commands assigned, and of rendernodes assigned commands, at each cycle
+    assignmentCounts = []
+    assignedRenderNodeCounts = []
+    # cycle of the first assignment of each running command, and cycle at which each command is done
+    startCycles = {}
+    doneCycles = {}
+
+    def countedComputeAssignments():
+        # the assignments are grouped by rendernode: (rendernode, [commands])
+        assignments = computeAssignments()
+        assignmentCounts.append(sum(len(commands) for rendernode, commands in assignments))
+        assignedRenderNodeCounts.append(len(assignments))
+        return assignments
+    dispatcher.computeAssignments = timed(timings, "computeAssignments", countedComputeAssignments)
+
+    for cycle in xrange(options.cycles):
+        clock.cycle = cycle
+        dispatcher.queueWorkload(Workload(lambda: None))
+        start = time.time()
+        dispatcher.mainLoop()
+        timings["mainLoop"].append(time.time() - start)
+        start = time.time()
+        dispatcher.threadPool.wait()
+        timings["waitRequests"].append(time.time() - start)
+        # complete the commands as the workers would do
+        start = time.time()
+        clock.cycle = cycle + 1
+        running = []
+        for rendernode in rendernodes:
+            for command in rendernode.commands.values():
+                if command.status in (CMD_ASSIGNED, CMD_RUNNING):
+                    startCycle = startCycles.setdefault(command.id, cycle)
+                    if cycle - startCycle + 1 >= max(command.nbFrames, 1):
+                        running.append((rendernode, command))
+        for rendernode, command in running[:int(len(running) * options.finishRatio)]:
+            dispatcher.updateCommandApply({'id': command.id, 'renderNodeName': rendernode.name, 'status': CMD_DONE,
+                                           'message': '', 'completion': 1.0})
+            del startCycles[command.id]
+            doneCycles[command.id] = cycle
+        for rendernode in rendernodes:
+            rendernode.lastAliveTime = time.time()
+        timings["completeCommands"].append(time.time() - start)
+
+    computeDuration = sum(timings["computeAssignments"])
+    # the number of cycles needed to complete each task, or the number of cycles run plus one if it is not
+    taskCompletionCycles = {'short': [], 'long': []}
+    for task in tree.tasks.values():
+        if getattr(task, 'commands', None):
+            cycles = max(doneCycles.get(command.id, options.cycles) for command in task.commands) + 1
+            taskIndex = int(task.name[len('task'):])
+            taskCompletionCycles['short' if isShortTask(options, taskIndex) else 'long'].append(cycles)
+    return {
+        'options': dict((name, getattr(options, name)) for name in ('pools', 'rendernodes', 'cores', 'ram', 'users', 'graphs', 'tasks', 'commands', 'taskCores', 'taskRam', 'packing', 'dependencies', 'licenses', 'frames', 'shortRatio', 'strategy', 'cycles', 'finishRatio')),
+        'setupDuration': setupDuration,
+        'phases': dict((name, summarize(values)) for name, values in timings.items()),
+        'cycleStats': dispatcher.cycleStats.to_json(),
+        'assignments': sum(assignmentCounts),
+        'assignmentsPerSecond': sum(assignmentCounts) / computeDuration if computeDuration else 0.0,
+        'assignedRenderNodes': sum(assignedRenderNodeCounts),
+        'taskCompletionCycles': dict((name, summarize(values)) for name, values in taskCompletionCycles.items()),
+        'remainingCommands': len([command for command in tree.commands.values() if command.status != CMD_DONE]),
+        'peakRssKb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main():
+    options = process_args()
+    logging.basicConfig(level=logging.DEBUG if options.DEBUG else logging.CRITICAL)
+    confdir = tempfile.mkdtemp(prefix="dispatcherbench")
+    try:
+        setup_settings(confdir, options)
+        results = run(options)
+    finally:
+        shutil.rmtree(confdir, ignore_errors=True)
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import httplib as http
+import select
+import threading
+import time
+
+
+class HTTPConnectionPool(object):
+    '''A bounded and thread-safe pool of keep-alive HTTP connections to a single host.
+
+    A connection is taken from the pool with acquire() and must be given back with
+    release(), telling whether it can be reused. Idle connections are dropped after
+    idleTimeout seconds, or as soon as the remote host has closed them.
+    '''
+
+    def __init__(self, host, port, maxSize=2, idleTimeout=30.0, timeout=20):
+        self.host = host
+        self.port = port
+        self.idleTimeout = idleTimeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(maxSize)
+        # idle connections as (connection, release time), the most recently used last
+        self.idleConnections = []
+
+    def acquire(self):
+        '''Returns an (HTTPConnection, reused) tuple, waiting if maxSize connections are in use.'''
+        self.slots.acquire()
+        try:
+            now = time.time()
+            while True:
+                with self.lock:
+                    if not self.idleConnections:
+                        break
+                    conn, releaseTime = self.idleConnections.pop()
+                if now - releaseTime < self.idleTimeout and self.isHealthy(conn):
+                    return conn, True
+                conn.close()
+            return http.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+        except:
+            self.slots.release()
+            raise
+
+    def release(self, conn, reusable=True):
+        '''Gives back a connection obtained with acquire(), closing it unless it is reusable.'''
+        try:
+            if reusable and conn.sock is not None:
+                with self.lock:
+                    self.idleConnections.append((conn, time.time()))
+            else:
+                conn.close()
+        finally:
+            self.slots.release()
+
+    def evictIdleConnections(self):
+        '''Closes the idle connections that have not been used for idleTimeout seconds.'''
+        limit = time.time() - self.idleTimeout
+        with self.lock:
+            evicted = [conn for conn, releaseTime in self.idleConnections if releaseTime <= limit]
+            self.idleConnections = [(conn, releaseTime) for conn, releaseTime in self.idleConnections if releaseTime > limit]
+        for conn in evicted:
+            conn.close()
+
+    def close(self):
+        '''Closes all the idle connections.'''
+        with self.lock:
+            idleConnections, self.idleConnections = self.idleConnections, []
+        for conn, releaseTime in idleConnections:
+            conn.close()
+
+    @staticmethod
+    def isHealthy(conn):
+        '''Returns False if the connection is closed, or if the remote host has closed or written to it while idle.'''
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, ValueError):
+            return False
+        return not readable
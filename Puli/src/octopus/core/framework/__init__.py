@@ -8,7 +8,8 @@ except ImportError:
     import json
 from octopus.core.communication.http import Http400
 from octopus.core.tools import Workload
-from tornado.web import RequestHandler
+from tornado.web import RequestHandler, HTTPError, asynchronous
+from tornado.ioloop import IOLoop
 
 __all__ = ['WSAppFramework', 'MainLoopApplication']
 __all__ += ['Controller', 'ControllerError', 'ResourceNotFoundErro', 'BaseResource']
@@ -17,9 +18,14 @@ import logging
 logger = logging.getLogger("dispatcher.webservice")
 
 
+## Makes a request handler method run in the main loop of the application.
+#
+# The IOLoop is not blocked meanwhile: the request is finished once the main loop has executed the method.
+#
 def queue(func):
+    @asynchronous
     def queued_func(self, *args, **kwargs):
-        return self.queueAndWait(func, self, *args, **kwargs)
+        self.queueAndFinish(func, self, *args, **kwargs)
     return queued_func
 
 
@@ -63,6 +69,26 @@ class BaseResource(tornado.web.RequestHandler):
     def getDispatchTree(self):
         return self.framework.application.dispatchTree
 
+    def getSnapshot(self):
+        '''Returns the snapshot of the model published by the main loop at the end of its last cycle,
+        and sets its age in the response headers.'''
+        snapshot = self.framework.application.snapshot
+        self.set_header('X-Snapshot-Age', '%.3f' % snapshot.age)
+        self.set_header('X-Snapshot-Cycle', str(snapshot.cycle))
+        self.set_header('X-Model-Version', str(snapshot.version))
+        return snapshot
+
+    def getSince(self):
+        '''Returns the version of the model given by the since argument of the request, or None
+        if the request asks for all the objects.'''
+        since = self.get_argument('since', None)
+        if since is None:
+            return None
+        try:
+            return int(since)
+        except ValueError:
+            raise Http400("Invalid since argument %r, expected a model version" % since)
+
     def get_error_html(self, status_code, exception=None, **kwargs):
         message = httplib.responses[status_code]
         if exception is not None and isinstance(exception, tornado.web.HTTPError):
@@ -72,6 +98,14 @@ class BaseResource(tornado.web.RequestHandler):
             "message": message,
             }
 
+    def write_error(self, status_code, **kwargs):
+        # tornado no longer calls get_error_html, the error is given either by the exception
+        # argument of send_error or by the exception raised in the handler
+        exception = kwargs.pop('exception', None)
+        if exception is None and 'exc_info' in kwargs:
+            exception = kwargs['exc_info'][1]
+        self.finish(self.get_error_html(status_code, exception=exception))
+
     @property
     def dispatcher(self):
         return self.framework.application
@@ -95,6 +129,31 @@ class BaseResource(tornado.web.RequestHandler):
         self.framework.application.queueWorkload(workload)
         return workload.wait()
 
+    def queueAndFinish(self, func, *args, **kwargs):
+        '''Queues func for the main loop and returns immediately, the request is finished on the IOLoop
+        once func has been executed.'''
+        ioloop = IOLoop.instance()
+        workload = Workload(lambda: func(*args, **kwargs),
+                            lambda workload: ioloop.add_callback(lambda: self.finishWorkload(workload)))
+        self.framework.application.queueWorkload(workload)
+
+    def finishWorkload(self, workload):
+        if self._finished:
+            return
+        if workload.error is not None:
+            error = workload.error[1]
+            if isinstance(error, ResourceNotFoundError):
+                error = HTTPError(404, str(error))
+            elif not isinstance(error, HTTPError):
+                logger.error("%s %s failed", self.request.method, self.request.uri, exc_info=workload.error)
+                error = HTTPError(500)
+        else:
+            error = workload.result if isinstance(workload.result, HTTPError) else None
+        if error is not None:
+            self.send_error(error.status_code, exception=error)
+        else:
+            self.finish()
+
     def writeCallback(self, chunk):
         data = self.request.arguments
         if 'callback' in data:
@@ -1,15 +1,23 @@
 import tornado
 import sys
+import time
 from threading import Event
 
 
 class Workload(object):
+    '''A job queued for the main loop.
 
-    def __init__(self, job):
+    Once the job has been executed, submit() wakes up the threads waiting for it with wait(),
+    and calls the callback, if any, with the workload as argument.
+    '''
+
+    def __init__(self, job, callback=None):
         self.event = Event()
         self.job = job
+        self.callback = callback
         self.result = None
         self.error = None
+        self.queuedTime = time.time()
 
     def __call__(self):
         try:
@@ -19,9 +27,14 @@ class Workload(object):
 
     def submit(self):
         self.event.set()
+        if self.callback is not None:
+            self.callback(self)
 
     def wait(self):
         self.event.wait()
+        return self.getResult()
+
+    def getResult(self):
         if isinstance(self.result, tornado.web.HTTPError):
             raise self.result
         else:
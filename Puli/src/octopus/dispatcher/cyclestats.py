@@ -0,0 +1,141 @@
+####################################################################################################
+# @file cyclestats.py
+# @package octopus.dispatcher
+# @author
+# @date 2014/05/20
+# @version 0.1
+#
+# This module provides the rate and the timing of the phases of the dispatch cycles, and the latency
+# of the workloads.
+#
+####################################################################################################
+
+import time
+import collections
+
+
+## Keeps the last samples of a value and computes their percentiles on demand.
+#
+class RollingHistogram(object):
+
+    def __init__(self, size):
+        self.samples = collections.deque(maxlen=size)
+
+    def add(self, value):
+        self.samples.append(value)
+
+    def last(self):
+        return self.samples[-1] if self.samples else 0.0
+
+    def mean(self):
+        return float(sum(self.samples)) / len(self.samples) if self.samples else 0.0
+
+    def to_json(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+        return {
+            'count': len(samples),
+            'mean': float(sum(samples)) / len(samples),
+            'p50': samples[(len(samples) - 1) // 2],
+            'p95': samples[(len(samples) - 1) * 95 // 100],
+            'max': samples[-1],
+        }
+
+
+## Records the start and the duration of each phase of the dispatch cycles, the workloads drained
+#  from the queue at the start of the cycles, the workloads executed and assignments computed by each
+#  cycle, and the time the workloads waited until they were answered.
+#
+# A cycle is started with startCycle(), each phase is closed with lap() and the cycle with endCycle().
+#
+class CycleStats(object):
+
+    PHASES = ('poll', 'updateCompletionAndStatus', 'updateRenderNodes', 'validateDependencies', 'workloads',
+              'updateDB', 'computeAssignments', 'sendAssignments', 'releaseFinishingStatus', 'publishSnapshot')
+
+    def __init__(self, size=500):
+        self.cycleCount = 0
+        self.phases = dict((name, RollingHistogram(size)) for name in self.PHASES)
+        self.starts = collections.deque(maxlen=size)
+        self.durations = RollingHistogram(size)
+        self.drainedWorkloads = RollingHistogram(size)
+        self.workloadCounts = RollingHistogram(size)
+        self.assignmentCounts = RollingHistogram(size)
+        self.workloadLatencies = RollingHistogram(2 * size)
+        self.lastCycle = None
+        # workloads executed since the start of the current cycle, including the ones executed between cycles
+        self.workloadCount = 0
+        self.current = None
+        self.cycleStart = self.phaseStart = 0.0
+
+    def addWorkloads(self, count):
+        self.workloadCount += count
+
+    ## Records the time elapsed between the queuing of a workload and its answer.
+    #
+    def addWorkloadLatency(self, latency):
+        self.workloadLatencies.add(latency)
+
+    def startCycle(self, drainedWorkloads):
+        self.cycleStart = self.phaseStart = time.time()
+        self.current = {'drainedWorkloads': drainedWorkloads, 'phases': {}}
+
+    def lap(self, phase):
+        now = time.time()
+        self.current['phases'][phase] = now - self.phaseStart
+        self.phaseStart = now
+
+    ## Closes the current cycle and returns its record.
+    #
+    def endCycle(self, assignmentCount):
+        record = self.current
+        record['duration'] = time.time() - self.cycleStart
+        record['start'] = self.cycleStart
+        record['workloads'] = self.workloadCount
+        record['assignments'] = assignmentCount
+        for phase, duration in record['phases'].items():
+            self.phases[phase].add(duration)
+        self.starts.append(self.cycleStart)
+        self.durations.add(record['duration'])
+        self.drainedWorkloads.add(record['drainedWorkloads'])
+        self.workloadCounts.add(self.workloadCount)
+        self.assignmentCounts.add(assignmentCount)
+        self.cycleCount += 1
+        self.workloadCount = 0
+        self.lastCycle = record
+        self.current = None
+        return record
+
+    ## Returns the number of cycles by second over the last cycles.
+    #
+    def rate(self):
+        if len(self.starts) < 2:
+            return 0.0
+        elapsed = time.time() - self.starts[0]
+        return len(self.starts) / elapsed if elapsed > 0 else 0.0
+
+    def to_json(self):
+        return {
+            'count': self.cycleCount,
+            'rate': self.rate(),
+            'duration': self.durations.to_json(),
+            'phases': dict((name, histogram.to_json()) for name, histogram in self.phases.items()),
+            'drainedWorkloads': self.drainedWorkloads.to_json(),
+            'workloads': self.workloadCounts.to_json(),
+            'workloadLatency': self.workloadLatencies.to_json(),
+            'assignments': self.assignmentCounts.to_json(),
+            'lastCycle': self.lastCycle,
+        }
+
+    ## Returns the rate and duration of the last cycles and the latency of the last workloads.
+    #
+    def summary(self):
+        return {
+            'count': self.cycleCount,
+            'rate': self.rate(),
+            'lastDuration': self.durations.last(),
+            'avgDuration': self.durations.mean(),
+            'avgWorkloadLatency': self.workloadLatencies.mean(),
+            'maxWorkloadLatency': max(self.workloadLatencies.samples) if self.workloadLatencies.samples else 0.0,
+        }
@@ -403,9 +403,13 @@ class PuliDB(object):
                 conn.cache.clear()
 
     ## Updates the provided elements to the database.
+    #
+    # The commands sharing the same values are updated with a single query.
+    #
     # @param elements the elements to update
     #
     def updateElements(self, elements):
+        commandsByValues = defaultdict(set)
         for element in elements:
             if isinstance(element, Command) or isinstance(element, TaskNode) or isinstance(element, FolderNode):
                 startTime = self.getDateFromTimeStamp(element.startTime)
@@ -415,16 +419,9 @@ class PuliDB(object):
             # /////////////// Handling of the Command
             if isinstance(element, Command):
                 if element.id:
-                    conn = Commands._connection
-                    fields = {Commands.q.status.fieldName: element.status,
-                              Commands.q.completion.fieldName: element.completion,
-                              Commands.q.startTime.fieldName: startTime,
-                              Commands.q.updateTime.fieldName: updateTime,
-                              Commands.q.endTime.fieldName: endTime}
-                    if element.renderNode:
-                        fields[Commands.q.assignedRNId.fieldName] = element.renderNode.id
-                    conn.query(conn.sqlrepr(Update(Commands.q, values=fields, where=(Commands.q.id == element.id))))
-                    conn.cache.clear()
+                    assignedRNId = element.renderNode.id if element.renderNode else None
+                    values = (element.status, element.completion, startTime, updateTime, endTime, assignedRNId)
+                    commandsByValues[values].add(element.id)
 
             # /////////////// Handling of the TaskNode
             elif isinstance(element, TaskNode):
@@ -472,6 +469,20 @@ class PuliDB(object):
             #         conn.query(conn.sqlrepr(Update(RenderNodes.q, values=fields, where=(RenderNodes.q.id == element.id))))
             #         conn.cache.clear()
 
+        # /////////////// Handling of the Commands
+        if commandsByValues:
+            conn = Commands._connection
+            for (status, completion, startTime, updateTime, endTime, assignedRNId), ids in commandsByValues.items():
+                fields = {Commands.q.status.fieldName: status,
+                          Commands.q.completion.fieldName: completion,
+                          Commands.q.startTime.fieldName: startTime,
+                          Commands.q.updateTime.fieldName: updateTime,
+                          Commands.q.endTime.fieldName: endTime}
+                if assignedRNId is not None:
+                    fields[Commands.q.assignedRNId.fieldName] = assignedRNId
+                conn.query(conn.sqlrepr(Update(Commands.q, values=fields, where=IN(Commands.q.id, sorted(ids)))))
+            conn.cache.clear()
+
     ## Mark the provided elements as archived.
     # @param elements the elements to archive
     #
@@ -861,6 +872,7 @@ class PuliDB(object):
                 # if the command was last reported as running, reassign the rendernode in the model
                 if cmd.status == 3:
                     cmd.renderNode.commands[cmd.id] = cmd
+                    cmd.renderNode.updateAvailability()
                     cmd.renderNode.reserveLicense(cmd, self.licenseManager)
                     cmd.renderNode.reserveRessources(cmd)
 
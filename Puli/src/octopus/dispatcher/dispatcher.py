@@ -4,7 +4,7 @@ from __future__ import with_statement
 import logging
 import socket
 import time
-from Queue import Queue
+from Queue import Queue, Empty
 from itertools import groupby
 import collections
 try:
@@ -22,6 +22,8 @@ from octopus.dispatcher import settings
 from octopus.dispatcher.poolman.filepoolman import FilePoolManager
 from octopus.dispatcher.poolman.wspoolman import WebServicePoolManager
 from octopus.dispatcher.licenses.licensemanager import LicenseManager
+from octopus.dispatcher.cyclestats import CycleStats
+from octopus.dispatcher.snapshot import SnapshotBuilder
 from octopus.dispatcher.model.enums import *
 
 
@@ -49,6 +51,12 @@ class Dispatcher(MainLoopApplication):
             return
         self.init = True
         self.nextCycle = time.time()
+        # start time of the last dispatch cycle
+        self.lastCycleTime = 0.0
+        # rate and durations of the last dispatch cycles, and latencies of the last workloads
+        self.cycleStats = CycleStats()
+        # workloads have been executed since the last dispatch cycle
+        self.pendingWorkloads = False
 
         MainLoopApplication.__init__(self, framework)
 
@@ -85,6 +93,9 @@ class Dispatcher(MainLoopApplication):
         self.defaultPool = self.dispatchTree.pools['default']
         LOGGER.info("loading dispatch rules")
         self.loadRules()
+        # the serialized model read by the webservice, published at the end of each cycle
+        self.snapshotBuilder = SnapshotBuilder(self.dispatchTree)
+        self.snapshot = self.snapshotBuilder.publish(self.cycle)
         # it should be better to have a maxsize
         self.queue = Queue(maxsize=10000)
 
@@ -181,76 +192,124 @@ class Dispatcher(MainLoopApplication):
                     self.dispatchTree.toCreateElements or
                     self.dispatchTree.toModifyElements)
 
+    def waitForWorkloads(self):
+        '''Waits for the workloads queued by the webservice until the next dispatch cycle is due.
+
+        Returns the list of all the workloads queued so far.
+        '''
+        period = settings.MIN_CYCLE_PERIOD if self.pendingWorkloads else settings.MAX_CYCLE_PERIOD
+        workloads = []
+        try:
+            workloads.append(self.queue.get(timeout=max(0.0, self.lastCycleTime + period - time.time())))
+            for i in xrange(self.queue.qsize()):
+                workloads.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        return workloads
+
+    def submitWorkloads(self, workloads):
+        now = time.time()
+        for workload in workloads:
+            self.cycleStats.addWorkloadLatency(now - workload.queuedTime)
+            workload.submit()
+
     def mainLoop(self):
-        '''Dispatcher main loop iteration.'''
+        '''Dispatcher main loop iteration.
+
+        A dispatch cycle is run as soon as a workload arrives, but not before MIN_CYCLE_PERIOD seconds have
+        elapsed since the previous one. Meanwhile, the arriving workloads are executed without dispatching.
+        '''
+        executedRequests = self.waitForWorkloads()
+        stats = self.cycleStats
+        stats.addWorkloads(len(executedRequests))
+        if executedRequests and time.time() < self.lastCycleTime + settings.MIN_CYCLE_PERIOD:
+            for workload in executedRequests:
+                workload()
+            self.pendingWorkloads = True
+            # the clients read the snapshot, it must show their changes once they are answered
+            self.snapshotBuilder.markDbElementsChanged()
+            self.snapshot = self.snapshotBuilder.publish(self.cycle)
+            self.submitWorkloads(executedRequests)
+            return
+
+        stats.startCycle(len(executedRequests))
+        self.lastCycleTime = time.time()
+        self.pendingWorkloads = False
         try:
             self.threadPool.poll()
         except NoResultsPending:
             pass
         else:
             LOGGER.info("finished some network requests")
+        stats.lap('poll')
         self.cycle += 1
         self.dispatchTree.updateCompletionAndStatus()
+        stats.lap('updateCompletionAndStatus')
         self.updateRenderNodes()
+        stats.lap('updateRenderNodes')
 
         self.dispatchTree.validateDependencies()
+        stats.lap('validateDependencies')
 
-        executedRequests = []
-        first = True
-        while first or not self.queue.empty():
-            workload = self.queue.get()
+        for workload in executedRequests:
             workload()
-            executedRequests.append(workload)
-            first = False
+        stats.lap('workloads')
 
         # update db
         self.updateDB()
+        stats.lap('updateDB')
 
         # compute and send command assignments to rendernodes
         assignments = self.computeAssignments()
+        stats.lap('computeAssignments')
         self.sendAssignments(assignments)
+        stats.lap('sendAssignments')
 
         # call the release finishing status on all rendernodes
         for renderNode in self.dispatchTree.renderNodes.values():
             renderNode.releaseFinishingStatus()
+        stats.lap('releaseFinishingStatus')
 
-        for workload in executedRequests:
-            workload.submit()
+        self.snapshot = self.snapshotBuilder.publish(self.cycle)
+        stats.lap('publishSnapshot')
+
+        record = stats.endCycle(sum(len(commands) for rendernode, commands in assignments))
+        if settings.SLOW_CYCLE_THRESHOLD and record['duration'] > settings.SLOW_CYCLE_THRESHOLD:
+            LOGGER.warning("slow cycle %d: %s", self.cycle, json.dumps(record, sort_keys=True))
+        self.submitWorkloads(executedRequests)
 
     def updateDB(self):
         if settings.DB_ENABLE:
             self.pulidb.createElements(self.dispatchTree.toCreateElements)
             self.pulidb.updateElements(self.dispatchTree.toModifyElements)
             self.pulidb.archiveElements(self.dispatchTree.toArchiveElements)
+        self.snapshotBuilder.markDbElementsChanged()
         self.dispatchTree.resetDbElements()
 
     def computeAssignments(self):
         '''Computes and returns a list of (rendernode, command) assignments.'''
         from .model.node import NoRenderNodeAvailable
         # if no rendernodes available, return
-        if not any(rn.isAvailable() for rn in self.dispatchTree.renderNodes.values()):
+        if not any(pool.hasAvailableRenderNodes() for pool in self.dispatchTree.pools.values()):
             return []
 
         assignments = []
 
-        # first create a set of entrypoints that are not done nor cancelled nor blocked nor paused and that have at least one command ready
-        entryPoints = set([poolShare.node for poolShare in self.dispatchTree.poolShares.values() if poolShare.node.status not in [NODE_BLOCKED, NODE_DONE, NODE_CANCELED, NODE_PAUSED] and poolShare.node.readyCommandCount > 0])
+        # the entry points that are not done nor cancelled nor blocked nor paused and that have at least one
+        # command ready are indexed by pool, and sorted by dispatchKey (priority) then by id (fifo)
+        self.dispatchTree.entryPoints.refresh()
+        entryPointsByPool = self.dispatchTree.entryPoints.byPool()
         # don't proceed to the calculation if no rns availables in the requested pools
         rnsBool = False
-        for pool, nodesiterator in groupby(entryPoints, lambda x: x.poolShares.values()[0].pool):
-            rnsAvailables = set([rn for rn in pool.renderNodes if rn.status not in [RN_UNKNOWN, RN_PAUSED, RN_WORKING]])
-            if len(rnsAvailables):
+        for pool, nodesList in entryPointsByPool:
+            if pool.hasAvailableRenderNodes():
                 rnsBool = True
         if not rnsBool:
             return []
 
-        # sort by pool for the groupby
-        entryPoints = sorted(entryPoints, key=lambda node: node.poolShares.values()[0].pool)
-
         # update the value of the maxrn for the poolshares (parallel dispatching)
-        for pool, nodesiterator in groupby(entryPoints, lambda x: x.poolShares.values()[0].pool):
+        for pool, nodesList in entryPointsByPool:
             # we are treating every active node of the pool
-            nodesList = [node for node in nodesiterator]
             # the new maxRN value is calculated based on the number of active jobs of the pool, and the number of online rendernodes of the pool
             rnsNotOffline = set([rn for rn in pool.renderNodes if rn.status not in [RN_UNKNOWN, RN_PAUSED]])
             rnsSize = len(rnsNotOffline)
@@ -267,12 +326,6 @@ class Dispatcher(MainLoopApplication):
             updatedmaxRN = rnsSize // len(nodesList)
             remainingRN = rnsSize % len(nodesList)
 
-            # sort by id (fifo)
-            nodesList = sorted(nodesList, key=lambda x: x.id)
-
-            # then sort by dispatchKey (priority)
-            nodesList = sorted(nodesList, key=lambda x: x.dispatchKey, reverse=True)
-
             for dk, nodeIterator in groupby(nodesList, lambda x: x.dispatchKey):
                 nodes = [node for node in nodeIterator]
                 # for each priority, if there is only one node, set the maxRN to -1
@@ -295,11 +348,8 @@ class Dispatcher(MainLoopApplication):
                             node.poolShares.values()[0].maxRN += 1
                             remainingRN -= 1
 
-        # now, we are treating every nodes
-        # sort by id (fifo)
-        entryPoints = sorted(entryPoints, key=lambda node: node.id)
-        # then sort by dispatchKey (priority)
-        entryPoints = sorted(entryPoints, key=lambda node: node.dispatchKey, reverse=True)
+        # now, we are treating every nodes, sorted by dispatchKey (priority) then by id (fifo)
+        entryPoints = self.dispatchTree.entryPoints
 
         ####
         #for entryPoint in entryPoints:
@@ -312,10 +362,8 @@ class Dispatcher(MainLoopApplication):
                 try:
                     for (rn, com) in entryPoint.dispatchIterator(lambda: self.queue.qsize() > 0):
                         assignments.append((rn, com))
-                        # increment the allocatedRN for the poolshare
-                        poolShare.allocatedRN += 1
-                        # save the active poolshare of the rendernode
-                        rn.currentpoolshare = poolShare
+                        # increment the allocatedRN for the poolshare and save the active poolshare of the rendernode
+                        rn.addPoolShare(com, poolShare)
                 except NoRenderNodeAvailable:
                     pass
         assignmentDict = collections.defaultdict(list)
@@ -326,41 +374,84 @@ class Dispatcher(MainLoopApplication):
     def updateRenderNodes(self):
         for rendernode in self.dispatchTree.renderNodes.values():
             rendernode.updateStatus()
+            rendernode.evictIdleConnections()
 
     def sendAssignments(self, assignmentList):
         '''Processes a list of (rendernode, command) assignments.'''
 
+        def buildCommandDict(rendernode, command):
+            root = command.task
+            ancestors = [root]
+            while root.parent:
+                root = root.parent
+                ancestors.append(root)
+            arguments = {}
+            environment = {
+                'PULI_USER': command.task.user,
+                'PULI_ALLOCATED_MEMORY': unicode(rendernode.usedRam[command.id]),
+                'PULI_ALLOCATED_CORES': unicode(rendernode.usedCoresNumber[command.id]),
+            }
+            for ancestor in ancestors:
+                arguments.update(ancestor.arguments)
+                environment.update(ancestor.environment)
+            arguments.update(command.arguments)
+            return {
+                "id": command.id,
+                "runner": str(command.task.runner),
+                "arguments": arguments,
+                "validationExpression": command.task.validationExpression,
+                "taskName": command.task.name,
+                "relativePathToLogDir": "%d" % command.task.id,
+                "environment": environment,
+            }
+
+        def sendBatchAssignment(rendernode, commands, commandDicts):
+            '''Sends all the commands in a single request and returns the failures, or None if the worker does not support it.'''
+            headers = {}
+            if not rendernode.idInformed:
+                headers["rnId"] = rendernode.id
+            body = json.dumps({"commands": commandDicts})
+            headers["Content-Length"] = len(body)
+            headers["Content-Type"] = "application/json"
+            try:
+                resp, data = rendernode.request("POST", "/commands/batch/", body, headers)
+            except rendernode.RequestFailed, e:
+                LOGGER.exception("Assignment of commands %r to worker %s failed: %r", [command.id for command in commands], rendernode.name, e)
+                return [(rendernode, command) for command in commands]
+            if resp.status == 404:
+                LOGGER.warning("Worker %s does not support batch assignments", rendernode.name)
+                rendernode.supportsBatchAssignment = False
+                return None
+            if not resp.status == 202:
+                LOGGER.error("Assignment request failed: commands %r on worker %s", [command.id for command in commands], rendernode.name)
+                return [(rendernode, command) for command in commands]
+            try:
+                results = dict((result["id"], result["status"]) for result in json.loads(data)["commands"])
+            except (TypeError, ValueError, KeyError):
+                LOGGER.error("Invalid response to the assignment of commands %r on worker %s: %r", [command.id for command in commands], rendernode.name, data)
+                return [(rendernode, command) for command in commands]
+            failures = []
+            for command in commands:
+                if results.get(command.id) in ("accepted", "running"):
+                    LOGGER.info("Sent assignment of command %d to worker %s", command.id, rendernode.name)
+                else:
+                    LOGGER.error("Assignment request failed: command %d on worker %s (%s)", command.id, rendernode.name, results.get(command.id))
+                    failures.append((rendernode, command))
+            return failures
+
         def sendAssignment(args):
             rendernode, commands = args
+            commandDicts = [buildCommandDict(rendernode, command) for command in commands]
+            if rendernode.supportsBatchAssignment:
+                failures = sendBatchAssignment(rendernode, commands, commandDicts)
+                if failures is not None:
+                    return failures
+            # the worker does not support batch assignments, send the commands one by one
             failures = []
-            for command in commands:
+            for command, commandDict in zip(commands, commandDicts):
                 headers = {}
                 if not rendernode.idInformed:
                     headers["rnId"] = rendernode.id
-                root = command.task
-                ancestors = [root]
-                while root.parent:
-                    root = root.parent
-                    ancestors.append(root)
-                arguments = {}
-                environment = {
-                    'PULI_USER': command.task.user,
-                    'PULI_ALLOCATED_MEMORY': unicode(rendernode.usedRam[command.id]),
-                    'PULI_ALLOCATED_CORES': unicode(rendernode.usedCoresNumber[command.id]),
-                }
-                for ancestor in ancestors:
-                    arguments.update(ancestor.arguments)
-                    environment.update(ancestor.environment)
-                arguments.update(command.arguments)
-                commandDict = {
-                    "id": command.id,
-                    "runner": str(command.task.runner),
-                    "arguments": arguments,
-                    "validationExpression": command.task.validationExpression,
-                    "taskName": command.task.name,
-                    "relativePathToLogDir": "%d" % command.task.id,
-                    "environment": environment,
-                }
                 body = json.dumps(commandDict)
                 headers["Content-Length"] = len(body)
                 headers["Content-Type"] = "application/json"
@@ -429,6 +520,7 @@ class Dispatcher(MainLoopApplication):
             if len(rn.commands) == 0 and command.status is not enums.CMD_CANCELED:
                 # in this case, re-add the command to the list of the rendernode
                 rn.commands[commandId] = command
+                rn.updateAvailability()
                 # we should re-reserve the lic
                 rn.reserveLicense(command, self.licenseManager)
                 LOGGER.warning("re-assigning command %d on %s. (TIMEOUT?)" % (commandId, rn.name))
@@ -14,26 +14,59 @@ class LicenseManager:
             self.name = name
             self.maximum = int(maximum)
             self.used = 0
-            self.currentUsingRenderNodes = []
+            # number of licenses held by each rendernode
+            self.holders = {}
+            # number of successful reservations, and of times a task had to wait for the exhausted license:
+            # a refused reservation, or a waiting task once between two releases
+            self.reservationCount = 0
+            self.waitCount = 0
 
         def __repr__(self):
             return "\"" + self.name + "\" : \"" + str(self.used) + " / " + str(self.maximum) + "\""
 
-        def reserve(self):
+        @property
+        def currentUsingRenderNodes(self):
+            return self.holders.keys()
+
+        def reserve(self, renderNode=None):
             if self.used < self.maximum:
                 self.used += 1
+                self.reservationCount += 1
+                if renderNode is not None:
+                    self.holders[renderNode] = self.holders.get(renderNode, 0) + 1
                 return True
+            self.waitCount += 1
             return False
 
-        def release(self):
+        def release(self, renderNode=None):
+            count = self.holders.get(renderNode)
+            if count is not None:
+                if count > 1:
+                    self.holders[renderNode] = count - 1
+                else:
+                    del self.holders[renderNode]
             if self.used > 0:
                 self.used -= 1
 
         def setMaxNumber(self, maxNumber):
             self.maximum = maxNumber
 
+        def getCounters(self):
+            return {
+                'maximum': self.maximum,
+                'used': self.used,
+                'holders': len(self.holders),
+                'reservations': self.reservationCount,
+                'waits': self.waitCount,
+            }
+
     def __init__(self):
         self.licenses = {}
+        # license expressions ("a&b") already parsed, as (licenses, unknown license names) tuples
+        self.requirements = {}
+        # incremented each time licenses are released or added, so that the nodes which could
+        # not get a license know when to try again
+        self.releaseGeneration = 0
         self.readLicensesData()
 
     def readLicensesData(self):
@@ -50,50 +83,69 @@ class LicenseManager:
                 if line:
                     newLicense = LicenseManager.License(*line.strip().split(" "))
                     self.licenses[newLicense.name] = newLicense
+        self.requirements.clear()
+        # licenses may have been added or raised
+        self.releaseGeneration += 1
+
+    ## Returns the licenses required by the given "&" separated expression, as a
+    #  (licenses, unknown license names) tuple. The expressions are parsed only once.
+    #
+    def getRequirements(self, licenseName):
+        try:
+            return self.requirements[licenseName]
+        except KeyError:
+            licenses = []
+            unknownNames = []
+            for licName in licenseName.split("&"):
+                if len(licName):
+                    if licName in self.licenses:
+                        licenses.append(self.licenses[licName])
+                    else:
+                        unknownNames.append(licName)
+            requirements = self.requirements[licenseName] = (tuple(licenses), tuple(unknownNames))
+            return requirements
 
     def releaseLicenseForRenderNode(self, licenseName, renderNode):
-        if "&" not in licenseName:
-            licenseName += "&"
-        for licName in licenseName.split("&"):
-            if len(licName):
-                try:
-                    lic = self.licenses[licName]
-                    try:
-                        if renderNode in lic.currentUsingRenderNodes:
-                            rnId = lic.currentUsingRenderNodes.index(renderNode)
-                            del lic.currentUsingRenderNodes[rnId]
-                        lic.release()
-                    except IndexError:
-                        print "Cannot release license %s for renderNode %s" % (licName, renderNode)
-                except KeyError:
-                    print "License %s not found" % licName
+        licenses, unknownNames = self.getRequirements(licenseName)
+        for lic in licenses:
+            lic.release(renderNode)
+        for licName in unknownNames:
+            print "License %s not found" % licName
+        self.releaseGeneration += 1
+
+    def isLicenseAvailable(self, licenseName):
+        '''Returns True if all the licenses of the given "&" separated list can currently be reserved.'''
+        licenses, unknownNames = self.getRequirements(licenseName)
+        if unknownNames:
+            return False
+        for lic in licenses:
+            if lic.used >= lic.maximum:
+                return False
+        return True
+
+    def countWait(self, licenseName):
+        '''Counts a wait on the first exhausted license of the given "&" separated list. Called when a task
+        gets blocked by its licenses, it is then not counted again before the next release.'''
+        licenses, unknownNames = self.getRequirements(licenseName)
+        for lic in licenses:
+            if lic.used >= lic.maximum:
+                lic.waitCount += 1
+                return
 
     def reserveLicenseForRenderNode(self, licenseName, renderNode):
-        if "&" not in licenseName:
-            licenseName += "&"
-        globalsuccess = True
-        liclist = []
-        for licName in licenseName.split("&"):
-            if len(licName):
-                try:
-                    lic = self.licenses[licName]
-                    success = lic.reserve()
-                    if success:
-                        lic.currentUsingRenderNodes.append(renderNode)
-                        liclist.append(lic)
-                    else:
-                        # if only one reservation fails, the whole reservation fails
-                        globalsuccess = False
-                except KeyError:
-                    print "License %s not found" % licName
-                    globalsuccess = False
-        # in case of reservation failure, release the already reserved licenses, if any
-        if not globalsuccess:
-            for lic in liclist:
-                rnId = lic.currentUsingRenderNodes.index(renderNode)
-                del lic.currentUsingRenderNodes[rnId]
-                lic.release()
-        return globalsuccess
+        licenses, unknownNames = self.getRequirements(licenseName)
+        for licName in unknownNames:
+            print "License %s not found" % licName
+        if unknownNames:
+            return False
+        for index, lic in enumerate(licenses):
+            if not lic.reserve(renderNode):
+                # if only one reservation fails, the whole reservation fails: release the already reserved licenses
+                for reservedLic in licenses[:index]:
+                    reservedLic.release(renderNode)
+                    reservedLic.reservationCount -= 1
+                return False
+        return True
 
     def showLicenses(self):
         for lic in self.licenses.values():
@@ -108,6 +160,9 @@ class LicenseManager:
         rep += "}"
         return rep
 
+    def getCounters(self):
+        return dict((lic.name, lic.getCounters()) for lic in self.licenses.values())
+
     def setMaxLicensesNumber(self, licenseName, number):
         try:
             lic = self.licenses[licenseName]
@@ -116,3 +171,6 @@ class LicenseManager:
         except KeyError:
             print "License %s not found... Creating new entry" % licenseName
             self.licenses[licenseName] = LicenseManager.License(licenseName, number)
+            # the expressions using this license were parsed without it
+            self.requirements.clear()
+        self.releaseGeneration += 1
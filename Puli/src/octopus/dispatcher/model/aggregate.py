@@ -0,0 +1,139 @@
+####################################################################################################
+# @file aggregate.py
+# @package dispatcher.model
+# @author
+# @date 2014/05/12
+# @version 0.1
+#
+# This module provides the incremental aggregates used to compute the status and completion of
+# the nodes and taskgroups from the ones of their commands, children or tasks.
+#
+####################################################################################################
+
+
+## Keeps the minimum or maximum of a multiset of values.
+#
+# When the current extremum is removed, it is recomputed on the next call to get().
+#
+class ExtremumTracker(object):
+
+    def __init__(self, function):
+        self.function = function
+        self.counts = {}
+        self.value = None
+        self.outdated = False
+
+    def add(self, value):
+        if value is None:
+            return
+        self.counts[value] = self.counts.get(value, 0) + 1
+        if not self.outdated:
+            self.value = value if self.value is None else self.function(self.value, value)
+
+    def remove(self, value):
+        if value is None:
+            return
+        count = self.counts[value] - 1
+        if count:
+            self.counts[value] = count
+        else:
+            del self.counts[value]
+            if value == self.value:
+                self.outdated = True
+
+    def get(self):
+        if self.outdated:
+            self.value = self.function(self.counts) if self.counts else None
+            self.outdated = False
+        return self.value
+
+
+## Status counters, completion and times of a set of members (commands, nodes or tasks).
+#
+# The contribution of each member is recorded when it is added or refreshed, so that
+# a change of one member only costs the removal of its old contribution and the addition
+# of the new one.
+#
+class Aggregate(object):
+
+    def __init__(self, members=()):
+        self.members = {}
+        self.statusCounts = {}
+        self.completionSum = 0.0
+        # number of members with a completion of 1.0, so that a complete set is not affected by rounding errors
+        self.completeCount = 0
+        self.readyCommandCount = 0
+        self.creationTime = ExtremumTracker(min)
+        self.startTime = ExtremumTracker(min)
+        self.updateTime = ExtremumTracker(max)
+        self.endTime = ExtremumTracker(max)
+        for member in members:
+            self.add(member)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, member):
+        return member in self.members
+
+    @property
+    def completion(self):
+        if not self.members or self.completeCount == len(self.members):
+            return 1.0
+        return self.completionSum / len(self.members)
+
+    def hasStatus(self, status):
+        return status in self.statusCounts
+
+    ## Adds a member, or refreshes its contribution if it has already been added.
+    #
+    def add(self, member):
+        values = (member.status, member.completion, getattr(member, 'readyCommandCount', 0),
+                  member.creationTime, member.startTime, member.updateTime, member.endTime)
+        oldValues = self.members.get(member)
+        if values == oldValues:
+            return
+        self.members[member] = values
+        # the new values are added before the old ones are removed to keep the extrema when possible
+        self._addValues(values)
+        if oldValues is not None:
+            self._removeValues(oldValues)
+
+    ## Refreshes the contribution of a member, if it has been added.
+    #
+    def refresh(self, member):
+        if member in self.members:
+            self.add(member)
+
+    def remove(self, member):
+        oldValues = self.members.pop(member, None)
+        if oldValues is not None:
+            self._removeValues(oldValues)
+
+    def _addValues(self, values):
+        status, completion, readyCommandCount, creationTime, startTime, updateTime, endTime = values
+        self.statusCounts[status] = self.statusCounts.get(status, 0) + 1
+        self.completionSum += completion
+        if completion == 1.0:
+            self.completeCount += 1
+        self.readyCommandCount += readyCommandCount
+        self.creationTime.add(creationTime)
+        self.startTime.add(startTime)
+        self.updateTime.add(updateTime)
+        self.endTime.add(endTime)
+
+    def _removeValues(self, values):
+        status, completion, readyCommandCount, creationTime, startTime, updateTime, endTime = values
+        count = self.statusCounts[status] - 1
+        if count:
+            self.statusCounts[status] = count
+        else:
+            del self.statusCounts[status]
+        self.completionSum -= completion
+        if completion == 1.0:
+            self.completeCount -= 1
+        self.readyCommandCount -= readyCommandCount
+        self.creationTime.remove(creationTime)
+        self.startTime.remove(startTime)
+        self.updateTime.remove(updateTime)
+        self.endTime.remove(endTime)
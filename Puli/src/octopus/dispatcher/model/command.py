@@ -16,6 +16,7 @@ from octopus.core.enums.command import *
 from octopus.core.enums.rendernode import RN_FINISHING
 from . import models
 from octopus.dispatcher import settings
+from octopus.dispatcher.strategies import ShortestJobFirstStrategy
 
 LOGGER = logging.getLogger('command')
 
@@ -145,6 +146,8 @@ class Command(models.Model):
                     if node.parent and node.parent.id != 1:
                         self.appendAvgTimeByFrameToNode(node.parent)
                     self.appendAvgTimeByFrameToNode(node)
+                    if node.averageTimeByFrame:
+                        ShortestJobFirstStrategy.recordTimeByFrame(self.task.runner, node.averageTimeByFrame)
 
     def appendAvgTimeByFrameToNode(self, node):
         node.averageTimeByFrameList.append(self.avgTimeByFrame)
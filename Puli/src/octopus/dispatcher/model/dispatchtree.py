@@ -1,6 +1,8 @@
 # coding: utf8
 
 import logging
+from bisect import bisect_left, insort
+from heapq import merge
 from weakref import WeakValueDictionary
 
 
@@ -8,6 +10,7 @@ from octopus.dispatcher.model import FolderNode, TaskNode, Pool, RenderNode, Tas
 from octopus.dispatcher.model.node import BaseNode
 from octopus.dispatcher.strategies import FifoStrategy, loadStrategyClass
 from octopus.core.enums.command import *
+from octopus.core.enums.node import NODE_BLOCKED, NODE_DONE, NODE_CANCELED, NODE_PAUSED
 from octopus.dispatcher.rules import RuleError
 
 
@@ -32,10 +35,71 @@ def splitpath(path):
 
 class ObjectListener(object):
 
-    def __init__(self, onCreationEvent=lambda obj, field: None, onDestructionEvent=lambda obj, field: None, onChangeEvent=lambda obj, field, oldvalue, newvalue: None):
+    def __init__(self, onCreationEvent=lambda obj, field: None, onDestructionEvent=lambda obj, field: None, onChangeEvent=lambda obj, field, oldvalue, newvalue: None, onBulkChangeEvent=None):
         self.onCreationEvent = onCreationEvent
         self.onDestructionEvent = onDestructionEvent
         self.onChangeEvent = onChangeEvent
+        self.onBulkChangeEvent = onBulkChangeEvent
+
+
+class EntryPointIndex(object):
+    '''Per-pool index of the entry points that can currently receive assignments.
+
+    Each pool is mapped to a list of (-dispatchKey, id, node) tuples kept sorted, so walking
+    it yields the entry points by decreasing dispatchKey, then by id (fifo). The change
+    listeners of the DispatchTree only flag nodes as dirty; they are re-evaluated when
+    refresh() is called, once per dispatch cycle.
+    '''
+
+    EXCLUDED_STATUS = (NODE_BLOCKED, NODE_DONE, NODE_CANCELED, NODE_PAUSED)
+
+    def __init__(self):
+        self.entries = {}
+        self.keys = {}
+        self.dirty = set()
+
+    def invalidate(self, node):
+        self.dirty.add(node)
+
+    def discard(self, node):
+        self.dirty.discard(node)
+        self._remove(node)
+
+    def isDispatchable(self, node):
+        return bool(node.poolShares and
+                    node.status not in self.EXCLUDED_STATUS and
+                    node.readyCommandCount > 0)
+
+    def refresh(self):
+        dirty, self.dirty = self.dirty, set()
+        for node in dirty:
+            self._remove(node)
+            if self.isDispatchable(node):
+                pool = node.poolShares.values()[0].pool
+                key = (-node.dispatchKey, node.id, node)
+                insort(self.entries.setdefault(pool, []), key)
+                self.keys[node] = (pool, key)
+
+    def _remove(self, node):
+        try:
+            pool, key = self.keys.pop(node)
+        except KeyError:
+            return
+        entries = self.entries[pool]
+        del entries[bisect_left(entries, key)]
+        if not entries:
+            del self.entries[pool]
+
+    ## Returns a list of (pool, entry points) tuples, the entry points of each pool being sorted.
+    #
+    def byPool(self):
+        return [(pool, [key[2] for key in entries]) for (pool, entries) in self.entries.items()]
+
+    def __iter__(self):
+        return (key[2] for key in merge(*self.entries.values()))
+
+    def __len__(self):
+        return len(self.keys)
 
 
 class DispatchTree(object):
@@ -51,6 +115,7 @@ class DispatchTree(object):
         self.rules = []
         self.poolShares = {}
         self.commands = {}
+        self.entryPoints = EntryPointIndex()
         # deduced properties
         self.nodeMaxId = 0
         self.poolMaxId = 0
@@ -66,7 +131,7 @@ class DispatchTree(object):
         self.taskListener = ObjectListener(self.onTaskCreation, self.onTaskDestruction, self.onTaskChange)
         self.renderNodeListener = ObjectListener(self.onRenderNodeCreation, self.onRenderNodeDestruction, self.onRenderNodeChange)
         self.poolListener = ObjectListener(self.onPoolCreation, self.onPoolDestruction, self.onPoolChange)
-        self.commandListener = ObjectListener(onCreationEvent=self.onCommandCreation, onChangeEvent=self.onCommandChange)
+        self.commandListener = ObjectListener(onCreationEvent=self.onCommandCreation, onChangeEvent=self.onCommandChange, onBulkChangeEvent=self.onCommandsChange)
         self.poolShareListener = ObjectListener(self.onPoolShareCreation)
         self.modifiedNodes = []
 
@@ -94,6 +159,7 @@ class DispatchTree(object):
         self.rules = None
         self.commands.clear()
         self.poolShares = None
+        self.entryPoints = None
         self.modifiedNodes = None
         self.toCreateElements = None
         self.toModifyElements = None
@@ -103,11 +169,8 @@ class DispatchTree(object):
         nodenames = splitpath(path)
         node = self.root
         for name in nodenames:
-            for child in node.children:
-                if child.name == name:
-                    node = child
-                    break
-            else:
+            node = node.getChildByName(name)
+            if node is None:
                 return default
         return node
 
@@ -115,21 +178,33 @@ class DispatchTree(object):
         self.root.updateCompletionAndStatus()
 
     def validateDependencies(self):
-        nodes = set()
+        '''Blocks or unblocks the commands of the tasks depending on the nodes whose status changed.
+
+        Only the dependent nodes are visited: a dependent TaskNode affects its task, a dependent
+        FolderNode affects the tasks of all its descendant TaskNodes.
+        '''
+        tasks = []
+        visitedTasks = set()
+        visitedNodes = set()
         for dependency in self.modifiedNodes:
-            for node in dependency.reverseDependencies:
-                nodes.add(node)
-        del self.modifiedNodes[:]
-        for node in nodes:
-            if isinstance(node, TaskNode):
-                if node.checkDependenciesSatisfaction():
-                    for cmd in node.task.commands:
-                        if cmd.status == CMD_BLOCKED:
-                            cmd.status = CMD_READY
+            nodes = list(dependency.reverseDependencies)
+            while nodes:
+                node = nodes.pop()
+                if node in visitedNodes:
+                    continue
+                visitedNodes.add(node)
+                if isinstance(node, TaskNode):
+                    if node.task not in visitedTasks:
+                        visitedTasks.add(node.task)
+                        tasks.append((node.task, node))
                 else:
-                    for cmd in node.task.commands:
-                        if cmd.status == CMD_READY:
-                            cmd.status = CMD_BLOCKED
+                    nodes.extend(node.children)
+        del self.modifiedNodes[:]
+        for task, node in tasks:
+            if node.checkDependenciesSatisfaction():
+                task.setCommandsStatus([cmd for cmd in task.commands if cmd.status == CMD_BLOCKED], CMD_READY)
+            else:
+                task.setCommandsStatus([cmd for cmd in task.commands if cmd.status == CMD_READY], CMD_BLOCKED)
 
     def registerNewGraph(self, graph):
         user = graph['user']
@@ -309,6 +384,7 @@ class DispatchTree(object):
                 self.unregisterElementsFromTree(node)
         # /////////////// Handling of the TaskNode
         elif isinstance(element, TaskNode):
+            self.entryPoints.discard(element)
             # remove the element from the children of the parent
             if element.parent:
                 element.parent.removeChild(element)
@@ -324,6 +400,7 @@ class DispatchTree(object):
                 self.unregisterElementsFromTree(dependency)
         # /////////////// Handling of the FolderNode
         elif isinstance(element, FolderNode):
+            self.entryPoints.discard(element)
             if element.parent:
                 element.parent.removeChild(element)
             if element.poolShares:
@@ -370,9 +447,17 @@ class DispatchTree(object):
             node.parent = self.root
 
     def onNodeDestruction(self, node):
+        self.entryPoints.discard(node)
         del self.nodes[node.id]
 
     def onNodeChange(self, node, field, oldvalue, newvalue):
+        # readyCommandCount is a runtime counter, it is not stored in the database
+        if field == "readyCommandCount":
+            if node.poolShares:
+                self.entryPoints.invalidate(node)
+            return
+        if field in ("status", "dispatchKey", "poolShares"):
+            self.entryPoints.invalidate(node)
         # FIXME: do something when nodes are reparented from or to the root node
         if node.id is not None:
             self.toModifyElements.append(node)
@@ -426,11 +511,42 @@ class DispatchTree(object):
         else:
             self.commandMaxId = max(self.commandMaxId, command.id)
         self.commands[command.id] = command
+        if command.task is not None and command.status == CMD_READY:
+            command.task.addReadyCommand(command)
 
     def onCommandChange(self, command, field, oldvalue, newvalue):
         self.toModifyElements.append(command)
+        if field in ("status", "task") and command.task is not None and command.status == CMD_READY:
+            command.task.addReadyCommand(command)
+        if field == "task" and oldvalue is not None:
+            for node in oldvalue.nodes.values():
+                node.invalidate(command)
         if command.task is not None:
             for node in command.task.nodes.values():
+                node.invalidate(command)
+
+    def onCommandsChange(self, changes):
+        '''Handles the changes collected on commands while their events were suppressed.
+
+        Each command is stored once in the database, and the nodes of each task are invalidated once.
+        '''
+        commands = []
+        changedCommands = set()
+        changedTasks = {}
+        for (command, field, oldvalue, newvalue) in changes:
+            if command not in changedCommands:
+                changedCommands.add(command)
+                commands.append(command)
+            if field in ("status", "task") and command.task is not None and command.status == CMD_READY:
+                command.task.addReadyCommand(command)
+            if field == "task" and oldvalue is not None:
+                changedTasks.setdefault(oldvalue, set()).add(command)
+            if command.task is not None:
+                changedTasks.setdefault(command.task, set()).add(command)
+        self.toModifyElements.extend(commands)
+        for task, taskCommands in changedTasks.items():
+            for node in task.nodes.values():
+                node.dirtyMembers.update(taskCommands)
                 node.invalidate()
 
     ### methods called after interaction with a Pool
@@ -443,3 +559,4 @@ class DispatchTree(object):
         else:
             self.poolShareMaxId = max(self.poolShareMaxId, poolShare.id)
         self.poolShares[poolShare.id] = poolShare
+        self.entryPoints.invalidate(poolShare.node)
@@ -4,9 +4,15 @@ Created on Nov 2, 2009
 @author: Olivier Derpierre
 '''
 
+from contextlib import contextmanager
+
 
 class Field(object):
 
+    # whether the json value of the field only changes when the field is assigned, the values of the
+    # other fields are read from the referenced objects or containers every time
+    cacheable = True
+
     def __init__(self, allow_null=False):
         self.name = None
         self.allow_null = allow_null
@@ -40,6 +46,8 @@ class ModelType(type):
             field.name = name
             del attributes[name]
         attributes['FIELDS'] = fields
+        attributes['CACHED_FIELDS'] = tuple(field for field in fields.values() if field.cacheable)
+        attributes['UNCACHED_FIELDS'] = tuple(field for field in fields.values() if not field.cacheable)
         attributes['changeListeners'] = []
         return super(ModelType, cls).__new__(cls, clsname, bases, attributes)
 
@@ -56,6 +64,12 @@ class Model(object):
 
     id = Field()
 
+    # the change events collected while the events of this class are suppressed
+    _bulkChanges = None
+
+    # the json values of the cached fields, reset when one of the fields is assigned
+    _jsonCache = None
+
     def __init__(self, **kwargs):
         self._changeReady = False
         for (key, value) in kwargs.items():
@@ -71,6 +85,14 @@ class Model(object):
         oldvalue = getattr(self, name, None)
         super(Model, self).__setattr__(name, value)
         if name in self.FIELDS:
+            self.__dict__['_jsonCache'] = None
+            if self.__dict__.get('_changeReady'):
+                # the fields are validated when they are written, not every time they are serialized
+                try:
+                    self.FIELDS[name].validate_instance(self)
+                except ValueError:
+                    super(Model, self).__setattr__(name, oldvalue)
+                    raise
             try:
                 self.fireChangeEvent(self, name, oldvalue, value)
             except Exception:
@@ -78,8 +100,13 @@ class Model(object):
                 logging.getLogger("model").exception("error while running event listener")
 
     def to_json(self):
-        self.validate()
-        return dict((field.name, field.to_json(self)) for field in self.FIELDS.values())
+        cache = self._jsonCache
+        if cache is None:
+            cache = self.__dict__['_jsonCache'] = dict((field.name, field.to_json(self)) for field in self.CACHED_FIELDS)
+        jsonRepr = dict(cache)
+        for field in self.UNCACHED_FIELDS:
+            jsonRepr[field.name] = field.to_json(self)
+        return jsonRepr
 
     def validate(self):
         for field in self.FIELDS.values():
@@ -106,6 +133,9 @@ class Model(object):
     def fireChangeEvent(cls, obj, field, oldvalue, newvalue):
         if not hasattr(obj, "_changeReady") or not obj._changeReady:
             return
+        if cls._bulkChanges is not None:
+            cls._bulkChanges.append((obj, field, oldvalue, newvalue))
+            return
         for base in obj.__class__.__mro__:
             if hasattr(base, 'changeListeners'):
                 for changeListener in base.changeListeners:
@@ -113,9 +143,56 @@ class Model(object):
         for changeListener in obj.changeListeners:
             changeListener.onChangeEvent(obj, field, oldvalue, newvalue)
 
+    ## Suppresses the change events of the instances of this class, and delivers them on exit.
+    #
+    # The listeners which define an onBulkChangeEvent(changes) method receive all the changes
+    # at once, as a list of (obj, field, oldvalue, newvalue) tuples. The other listeners receive
+    # them one by one; the changes they make in turn are collected as well.
+    #
+    @classmethod
+    @contextmanager
+    def suppressedChangeEvents(cls):
+        if cls._bulkChanges is not None:
+            # nested scope, the changes are delivered by the outer one
+            yield
+            return
+        cls._bulkChanges = []
+        try:
+            yield
+        finally:
+            try:
+                cls.fireBulkChangeEvent()
+            finally:
+                cls._bulkChanges = None
+
+    @classmethod
+    def fireBulkChangeEvent(cls):
+        listeners = [changeListener for base in cls.__mro__ if hasattr(base, 'changeListeners')
+                     for changeListener in base.changeListeners]
+        bulkListeners = [changeListener for changeListener in listeners
+                         if getattr(changeListener, 'onBulkChangeEvent', None) is not None]
+        listeners = [changeListener for changeListener in listeners if changeListener not in bulkListeners]
+        changes = []
+        while cls._bulkChanges:
+            batch, cls._bulkChanges = cls._bulkChanges, []
+            changes.extend(batch)
+            for (obj, field, oldvalue, newvalue) in batch:
+                try:
+                    for changeListener in listeners + obj.changeListeners:
+                        changeListener.onChangeEvent(obj, field, oldvalue, newvalue)
+                except Exception:
+                    import logging
+                    logging.getLogger("model").exception("error while running event listener")
+        cls._bulkChanges = None
+        if changes:
+            for changeListener in bulkListeners:
+                changeListener.onBulkChangeEvent(changes)
+
 
 class ModelField(Field):
 
+    cacheable = False
+
     def __init__(self, allow_null=False, indexField='id'):
         Field.__init__(self, allow_null)
         self.indexField = indexField
@@ -129,6 +206,8 @@ class ModelField(Field):
 
 class ModelListField(Field):
 
+    cacheable = False
+
     def __init__(self, allow_null=False, indexField='id'):
         Field.__init__(self, allow_null)
         self.indexField = indexField
@@ -144,6 +223,8 @@ class ModelListField(Field):
 
 class ModelDictField(Field):
 
+    cacheable = False
+
     def to_json(self, instance):
         value_dict = getattr(instance, self.name)
         return [value.id for value in value_dict.values()]
@@ -155,6 +236,8 @@ class ModelDictField(Field):
 
 class ListField(Field):
 
+    cacheable = False
+
     def to_json(self, instance):
         value = getattr(instance, self.name)
         return value[:]
@@ -206,6 +289,8 @@ class FloatField(Field):
 
 class DictField(Field):
 
+    cacheable = False
+
     def __init__(self, as_item_list=False, **kwargs):
         Field.__init__(self, **kwargs)
         self.as_item_list = as_item_list
@@ -265,12 +350,6 @@ def test():
     Task.changeListeners.append(l)
 
     t = MegaTask()
-    try:
-        print t.to_json()
-    except ValueError:
-        print "ValueError as expected"
-    else:
-        print "errrr"
 
     t.id = 7
     t.name = "some task"
@@ -278,6 +357,15 @@ def test():
     t.taskGroup = None
     t.plop = False
 
+    try:
+        t.status = "not a status"
+    except ValueError:
+        print "ValueError as expected"
+    else:
+        print "errrr"
+    assert t.status == 42
+    assert t.to_json()['status'] == 42
+
     assert t.status == 42
     assert t.taskGroup == None
     assert t.plop == False
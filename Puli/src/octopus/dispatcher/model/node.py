@@ -1,8 +1,9 @@
 from time import time
-from collections import defaultdict
 from weakref import WeakKeyDictionary
 
 from octopus.dispatcher.model.enums import *
+from octopus.dispatcher import settings
+from octopus.dispatcher.model.aggregate import Aggregate
 
 from . import models
 
@@ -15,20 +16,30 @@ class NoRenderNodeAvailable(BaseException):
 
 
 class DependencyListField(models.Field):
+    cacheable = False
+
     def to_json(self, node):
         return [[dep.id, statusList] for (dep, statusList) in node.dependencies]
 
 
 class PoolShareDictField(models.Field):
+    cacheable = False
+
     def to_json(self, instance):
         return [[poolShare.id, poolShare.pool.name] for poolShare in instance.poolShares.values()]
 
 
 class FolderNodeChildrenField(models.Field):
+    cacheable = False
+
     def to_json(self, instance):
         return [child.id for child in instance.children]
 
 
+# the fields of a node which are aggregated by its parent
+AGGREGATED_FIELDS = frozenset(('status', 'completion', 'readyCommandCount', 'creationTime', 'startTime', 'updateTime', 'endTime'))
+
+
 class BaseNode(models.Model):
 
     dispatcher = None
@@ -93,6 +104,8 @@ class BaseNode(models.Model):
         self.lastDependenciesSatisfaction = False
         self.lastDependenciesSatisfactionDispatchCycle = -1
         self.readyCommandCount = 0
+        # the license release generation at which this node was found unable to get its licenses
+        self.licenseBlockedGeneration = None
         self.averageTimeByFrameList = []
         self.averageTimeByFrame = 0.0
         self.minTimeByFrame = 0.0
@@ -137,12 +150,48 @@ class BaseNode(models.Model):
         obj = super(BaseNode, cls).__new__(cls, *args, **kwargs)
         obj._parent_value = None
         obj.invalidated = True
+        # the children or commands whose changes have not been aggregated yet
+        obj.dirtyMembers = set()
         return obj
 
     def __setattr__(self, name, value):
         if name == 'parent':
             self.setParentValue(value)
-        super(BaseNode, self).__setattr__(name, value)
+        elif name == 'name':
+            oldvalue = self.__dict__.get(name)
+            super(BaseNode, self).__setattr__(name, value)
+            if oldvalue != value and self.parent is not None:
+                self.parent.renameChild(self, oldvalue)
+        elif name in AGGREGATED_FIELDS:
+            oldvalue = self.__dict__.get(name)
+            super(BaseNode, self).__setattr__(name, value)
+            if oldvalue != value:
+                if name == 'readyCommandCount':
+                    # readyCommandCount is not a model field, but the dispatch tree needs to know
+                    # when it changes on an entry point to keep its index up to date, and the
+                    # snapshot of the model on any node
+                    self.fireChangeEvent(self, name, oldvalue, value)
+                if self.parent is not None:
+                    self.parent.invalidate(self)
+                    if name == 'readyCommandCount':
+                        # the ancestors are notified when their own count is aggregated
+                        self.parent.strategy.on_child_change(self.parent, self)
+        elif name in ('priority', 'paused'):
+            oldvalue = self.__dict__.get(name)
+            super(BaseNode, self).__setattr__(name, value)
+            if oldvalue != value and self.parent is not None:
+                self.parent.strategy.on_child_change(self.parent, self)
+        elif name == 'averageTimeByFrame':
+            oldvalue = self.__dict__.get(name)
+            super(BaseNode, self).__setattr__(name, value)
+            if oldvalue != value:
+                # the expected work of the ancestors depends on it as well
+                node = self
+                while node.parent is not None:
+                    node.parent.strategy.on_child_change(node.parent, node)
+                    node = node.parent
+        else:
+            super(BaseNode, self).__setattr__(name, value)
 
     def setParentValue(self, parent):
         if self.parent is parent:
@@ -164,6 +213,11 @@ class BaseNode(models.Model):
     def updateCompletionAndStatus(self):
         raise NotImplementedError
 
+    ## Returns True if the commands of this node cannot be dispatched until licenses are released.
+    #
+    def isLicenseBlocked(self):
+        return self.licenseBlockedGeneration == self.dispatcher.licenseManager.releaseGeneration
+
     def __repr__(self):
         nodes = [self]
         parent = self.parent
@@ -175,11 +229,21 @@ class BaseNode(models.Model):
 
     parent_value = property(lambda self: self._parent_value, setParentValue)
 
-    def invalidate(self):
-        self.invalidated = True
-        while self.parent and not self.parent.invalidated:
-            self.parent.invalidated = True
-            self = self.parent
+    ## Marks this node and its ancestors as needing an update of their completion and status.
+    #
+    # @param member the child or command whose change must be aggregated, if any
+    #
+    def invalidate(self, member=None):
+        if member is not None:
+            self.dirtyMembers.add(member)
+        node = self
+        # an already invalidated node has already been registered as dirty in its parent
+        while not node.invalidated:
+            node.invalidated = True
+            if node.parent is None:
+                break
+            node.parent.dirtyMembers.add(node)
+            node = node.parent
 
 
 class FolderNode(BaseNode):
@@ -205,6 +269,9 @@ class FolderNode(BaseNode):
     def __init__(self, id, name, parent, user, priority, dispatchKey, maxRN, strategy, creationTime=None, startTime=None, updateTime=None, endTime=None, status=NODE_DONE, taskGroup=None):
         BaseNode.__init__(self, id, name, parent, user, priority, dispatchKey, maxRN, creationTime, startTime, updateTime, endTime, status)
         self.children = []
+        # the children by name, in the order they were added
+        self.childrenByName = {}
+        self.aggregate = Aggregate()
         self.strategy = strategy
         self.taskGroup = taskGroup
 
@@ -213,6 +280,13 @@ class FolderNode(BaseNode):
                 child.parent = self
             else:
                 self.children.append(child)
+                self.childrenByName.setdefault(child.name, []).append(child)
+                # the new child may not need the exhausted licenses
+                node = self
+                while node is not None and node.licenseBlockedGeneration is not None:
+                    node.licenseBlockedGeneration = None
+                    node = node.parent
+                self.strategy.on_child_change(self, child)
                 self.fireChildAddedEvent(child)
 
     def removeChild(self, child, setParent=True):
@@ -220,10 +294,39 @@ class FolderNode(BaseNode):
                 child.parent = None
             else:
                 self.children.remove(child)
+                self.removeChildName(child, child.name)
+                self.strategy.on_child_change(self, child)
+                self.aggregate.remove(child)
                 self.fireChildRemovedEvent(child)
 
+    def removeChildName(self, child, name):
+        namesakes = self.childrenByName[name]
+        namesakes.remove(child)
+        if not namesakes:
+            del self.childrenByName[name]
+
+    ## Updates the index of the children by name when a child is renamed.
+    #
+    def renameChild(self, child, oldName):
+        self.removeChildName(child, oldName)
+        self.childrenByName.setdefault(child.name, []).append(child)
+
+    ## Returns the child with the given name, or default if there is none.
+    #
+    # If several children have this name, the first one in the children list is returned.
+    #
+    def getChildByName(self, name, default=None):
+        namesakes = self.childrenByName.get(name)
+        if not namesakes:
+            return default
+        if len(namesakes) == 1:
+            return namesakes[0]
+        for child in self.children:
+            if child.name == name:
+                return child
+
     def fireChildAddedEvent(self, child):
-        self.invalidate()
+        self.invalidate(child)
         for l in self.changeListeners:
             try:
                 l.onChildAddedEvent(self, child)
@@ -244,14 +347,19 @@ class FolderNode(BaseNode):
     def dispatchIterator(self, stopFunc, ep=None):
         if ep is None:
             ep = self
+        if self.isLicenseBlocked():
+            return
         while True:
             if self.readyCommandCount == 0:
                 return
-            self.strategy.update(self, ep)
-            for child in self.children:
+            assigned = False
+            # the children blocked by the licenses among the children visited
+            blockedCount = 0
+            for child in self.strategy.children(self, ep):
                 try:
                     for assignment in child.dispatchIterator(stopFunc, ep):
                         node, command = assignment
+                        assigned = True
                         self.strategy.on_assignment(self, child, node)
                         yield assignment
                         if ep == self:
@@ -260,67 +368,76 @@ class FolderNode(BaseNode):
                 except NoRenderNodeAvailable:
                     return
                 else:
+                    if child.isLicenseBlocked():
+                        blockedCount += 1
                     if not stopFunc():
                         continue
             else:
+                if not assigned and blockedCount == len(self.children):
+                    self.licenseBlockedGeneration = self.dispatcher.licenseManager.releaseGeneration
                 return
 
     def updateCompletionAndStatus(self):
         if not self.invalidated:
             return
+        # only the children which have changed since the last update are visited
+        for child in list(self.dirtyMembers):
+            if child.parent is self:
+                child.updateCompletionAndStatus()
+        dirtyMembers, self.dirtyMembers = self.dirtyMembers, set()
+        # a new child is aggregated here, it may not be fully initialized when it is added
+        for child in dirtyMembers:
+            if child.parent is self:
+                self.aggregate.add(child)
+            else:
+                self.aggregate.remove(child)
+        aggregate = self.aggregate
         if not self.children:
             completion = 1.0
             status = NODE_DONE
         else:
-            self.readyCommandCount = 0
-            completion = 0.0
-            status = defaultdict(int)
-            for child in self.children:
-                child.updateCompletionAndStatus()
-                completion += child.completion
-                status[child.status] += 1
-                self.readyCommandCount += child.readyCommandCount
-            self.completion = completion / len(self.children)
+            self.readyCommandCount = aggregate.readyCommandCount
+            self.completion = aggregate.completion
 
-            if NODE_PAUSED in status:
+            if aggregate.hasStatus(NODE_PAUSED):
                 self.status = NODE_PAUSED
-            elif NODE_ERROR in status:
+            elif aggregate.hasStatus(NODE_ERROR):
                 self.status = NODE_ERROR
-            elif NODE_RUNNING in status:
+            elif aggregate.hasStatus(NODE_RUNNING):
                 self.status = NODE_RUNNING
-            elif NODE_READY in status:
+            elif aggregate.hasStatus(NODE_READY):
                 self.status = NODE_READY
-            elif NODE_BLOCKED in status:
+            elif aggregate.hasStatus(NODE_BLOCKED):
                 self.status = NODE_BLOCKED
-            elif NODE_CANCELED in status:
+            elif aggregate.hasStatus(NODE_CANCELED):
                 self.status = NODE_CANCELED
             else:
                 # all commands are DONE, ensure the completion is at 1.0 (in case of failed completion update from some workers)
                 self.completion = 1.0
                 self.status = NODE_DONE
 
-            times = [childNode.creationTime for childNode in self.children if childNode.creationTime is not None]
-            if times:
-                self.creationTime = min(times)
+            creationTime = aggregate.creationTime.get()
+            if creationTime is not None:
+                self.creationTime = creationTime
                 if self.taskGroup and (self.taskGroup.creationTime is None or self.taskGroup.creationTime > self.creationTime):
                     self.taskGroup.creationTime = self.creationTime
 
-            times = [childNode.startTime for childNode in self.children if childNode.startTime is not None]
-            if times:
-                self.startTime = min(times)
+            startTime = aggregate.startTime.get()
+            if startTime is not None:
+                self.startTime = startTime
                 if self.taskGroup and (self.taskGroup.startTime is None or self.taskGroup.startTime > self.startTime):
                     self.taskGroup.startTime = self.startTime
 
-            times = [childNode.updateTime for childNode in self.children if childNode.updateTime is not None]
-            if times:
-                self.updateTime = max(times)
+            updateTime = aggregate.updateTime.get()
+            if updateTime is not None:
+                self.updateTime = updateTime
                 if self.taskGroup and (self.taskGroup.updateTime is None or self.taskGroup.updateTime > self.updateTime):
                     self.taskGroup.updateTime = self.updateTime
 
             if isFinalNodeStatus(self.status):
-                times = [childNode.endTime for childNode in self.children if childNode.endTime is not None]
-                if times:
-                    self.endTime = max(times)
+                endTime = aggregate.endTime.get()
+                if endTime is not None:
+                    self.endTime = endTime
                     if self.taskGroup and (self.taskGroup.endTime is None or
                                            self.taskGroup.endTime > self.taskGroup.endTime):
                         self.taskGroup.endTime = self.endTime
@@ -330,7 +447,7 @@ class FolderNode(BaseNode):
                     self.taskGroup.endTime = None
         self.invalidated = False
         if self.taskGroup:
-            # FIXME: suboptimal... lazy update someday ?
+            # returns at once if none of the tasks of the group has changed
             self.taskGroup.updateStatusAndCompletion()
 
     def setPaused(self, paused):
@@ -375,6 +492,8 @@ class TaskNode(BaseNode):
         BaseNode.__init__(self, id, name, parent, user, priority, dispatchKey, maxRN, creationTime, startTime, updateTime, endTime, status)
         self.task = task
         self.paused = paused
+        # built on the first update
+        self.aggregate = None
 
     def dispatchIterator(self, stopFunc, ep=None):
         if ep is None:
@@ -383,11 +502,17 @@ class TaskNode(BaseNode):
             return
         if self.paused:
             return
-        # ensure we are treating the commands in the order they arrived
-        sorted(self.task.commands, key=lambda x: x.id)
-        for command in self.task.commands:
-            if command.status != CMD_READY:
-                continue
+        if self.task.lic:
+            # skip the task until licenses are released if its licenses are exhausted
+            if self.isLicenseBlocked():
+                return
+            licenseManager = self.dispatcher.licenseManager
+            if not licenseManager.isLicenseAvailable(self.task.lic):
+                licenseManager.countWait(self.task.lic)
+                self.licenseBlockedGeneration = licenseManager.releaseGeneration
+                return
+        # the ready commands are treated in the order they arrived
+        for command in self.task.iterReadyCommands():
             renderNode = self.reserve_rendernode(command, ep)
             if renderNode:
                 # command.assignment_date = time()
@@ -405,14 +530,25 @@ class TaskNode(BaseNode):
         if ep is None:
             ep = self
         for poolshare in [poolShare for poolShare in ep.poolShares.values() if poolShare.hasRenderNodesAvailable()]:
-            # first, sort the rendernodes according their performance value
-            rnList = sorted(poolshare.pool.renderNodes, key=lambda rn: rn.performance, reverse=True)
-            for rendernode in rnList:
-                if rendernode.isAvailable() and rendernode.canRun(command):
-                    if rendernode.reserveLicense(command, self.dispatcher.licenseManager):
-                        rendernode.addAssignment(command)
-                        #rendernode.reserveRessources(command)
-                        return rendernode
+            matchingRenderNodes = poolshare.pool.getMatchingRenderNodes(self.task)
+            # the available rendernodes are already sorted according their performance value
+            rendernodes = (rendernode for rendernode in poolshare.getAvailableRenderNodesIterator()
+                           if rendernode in matchingRenderNodes and rendernode.isAvailable() and rendernode.hasEnoughRessources(command))
+            if settings.RENDERNODE_PACKING:
+                # best fit first, min() keeping the first of the equal fits in the performance order
+                rendernodes = list(rendernodes)
+                rendernode = min(rendernodes, key=lambda rendernode: rendernode.getPackingFit(command)) if rendernodes else None
+            else:
+                rendernode = next(rendernodes, None)
+            if rendernode is None:
+                continue
+            if rendernode.reserveLicense(command, self.dispatcher.licenseManager):
+                rendernode.addAssignment(command)
+                #rendernode.reserveRessources(command)
+                return rendernode
+            # the licenses are shared by all the rendernodes, there is no point in trying the other ones
+            self.licenseBlockedGeneration = self.dispatcher.licenseManager.releaseGeneration
+            return None
         if not [poolShare for poolShare in ep.poolShares.values() if poolShare.hasRenderNodesAvailable()]:
             raise NoRenderNodeAvailable
         return None
@@ -420,59 +556,60 @@ class TaskNode(BaseNode):
     def updateCompletionAndStatus(self):
         if not self.invalidated:
             return
-        completion = 0.0
-        status = defaultdict(int)
-        self.readyCommandCount = 0
-        for command in self.task.commands:
-            completion += command.completion
-            status[command.status] += 1
-            if command.status == CMD_READY:
-                self.readyCommandCount += 1
-        if self.task.commands:
-            self.completion = completion / len(self.task.commands)
+        dirtyMembers, self.dirtyMembers = self.dirtyMembers, set()
+        if self.aggregate is None or len(self.aggregate) != len(self.task.commands):
+            # first update, or commands have been added to the task
+            self.aggregate = Aggregate(self.task.commands)
         else:
-            self.completion = 1.0
+            for command in dirtyMembers:
+                if command.task is self.task:
+                    self.aggregate.refresh(command)
+                else:
+                    self.aggregate.remove(command)
+        aggregate = self.aggregate
+        self.readyCommandCount = aggregate.statusCounts.get(CMD_READY, 0)
+        self.completion = aggregate.completion
 
         if self.paused:
             self.status = NODE_PAUSED
-        elif CMD_ERROR in status:
+        elif aggregate.hasStatus(CMD_ERROR):
             self.status = NODE_ERROR
-        elif CMD_TIMEOUT in status:
+        elif aggregate.hasStatus(CMD_TIMEOUT):
             self.status = NODE_ERROR
-        elif CMD_RUNNING in status:
+        elif aggregate.hasStatus(CMD_RUNNING):
             self.status = NODE_RUNNING
-        elif CMD_ASSIGNED in status:
+        elif aggregate.hasStatus(CMD_ASSIGNED):
             self.status = NODE_READY
-        elif CMD_FINISHING in status:
+        elif aggregate.hasStatus(CMD_FINISHING):
             self.status = NODE_RUNNING
-        elif CMD_READY in status:
+        elif aggregate.hasStatus(CMD_READY):
             self.status = NODE_READY
-        elif CMD_BLOCKED in status:
+        elif aggregate.hasStatus(CMD_BLOCKED):
             self.status = NODE_BLOCKED
-        elif CMD_CANCELED in status:
+        elif aggregate.hasStatus(CMD_CANCELED):
             self.status = NODE_CANCELED
         else:
             # all commands are DONE, ensure the completion is at 1.0 (in case of failed completion update from some workers)
             self.completion = 1.0
             self.status = NODE_DONE
 
-        times = [command.creationTime for command in self.task.commands if command.creationTime is not None]
-        if times:
-            self.creationTime = min(times)
+        creationTime = aggregate.creationTime.get()
+        if creationTime is not None:
+            self.creationTime = creationTime
 
-        times = [command.startTime for command in self.task.commands if command.startTime is not None]
-        if times:
-            self.startTime = min(times)
+        startTime = aggregate.startTime.get()
+        if startTime is not None:
+            self.startTime = startTime
 
-        times = [command.updateTime for command in self.task.commands if command.updateTime is not None]
-        if times:
-            self.updateTime = max(times)
+        updateTime = aggregate.updateTime.get()
+        if updateTime is not None:
+            self.updateTime = updateTime
 
         # only set the endTime on the node if it's done
         if self.status == NODE_DONE:
-            times = [command.endTime for command in self.task.commands if command.endTime is not None]
-            if times:
-                self.endTime = max(times)
+            endTime = aggregate.endTime.get()
+            if endTime is not None:
+                self.endTime = endTime
         else:
             self.endTime = None
 
@@ -486,9 +623,8 @@ class TaskNode(BaseNode):
         self.invalidated = False
 
     def checkDependenciesSatisfaction(self):
-        taskNodes = [taskNode
-                     for taskNode in self.dispatcher.dispatchTree.nodes.values()
-                     if isinstance(taskNode, TaskNode) and taskNode.task == self.task]
+        # the task is shared by its nodes of every view, all of them must have their dependencies satisfied
+        taskNodes = [taskNode for taskNode in self.task.nodes.values() if isinstance(taskNode, TaskNode)]
         return all(BaseNode.checkDependenciesSatisfaction(taskNode) for taskNode in taskNodes)
 
     def setPaused(self, paused):
@@ -9,6 +9,7 @@
 #
 ####################################################################################################
 
+from bisect import bisect_left, insort
 from weakref import WeakKeyDictionary
 
 from . import models
@@ -44,6 +45,8 @@ class PoolShare(models.Model):
         self.node = node
         self.allocatedRN = 0
         self.maxRN = int(maxRN)
+        # the rendernodes running commands of this poolshare, in packing mode
+        self.renderNodes = set()
         # check if we already have a poolShare with this pool and node
         if node in pool.poolShares:
             # reassign to the node if it already exists
@@ -63,8 +66,18 @@ class PoolShare(models.Model):
 
     def hasRenderNodesAvailable(self):
         if self.maxRN > 0 and self.allocatedRN >= self.maxRN:
-            return False
-        return any((rn.isAvailable() for rn in self.pool.renderNodes))
+            # in packing mode, the rendernodes already allocated can still receive commands
+            return any(rendernode.isAvailable() for rendernode in self.renderNodes)
+        return self.pool.hasAvailableRenderNodes()
+
+    ## Returns an iterator on the rendernodes this poolshare can assign commands to, by decreasing performance.
+    #
+    def getAvailableRenderNodesIterator(self):
+        if self.maxRN > 0 and self.allocatedRN >= self.maxRN:
+            rendernodes = [rendernode for rendernode in self.renderNodes if rendernode.isAvailable()]
+            rendernodes.sort(key=lambda rendernode: (-rendernode.performance, rendernode.id))
+            return iter(rendernodes)
+        return self.pool.getAvailableRenderNodesIterator()
 
     def __repr__(self):
         return "PoolShare(%r, %r, %r, %r)" % (self.id, self.pool.name if self.pool else None, self.node, self.maxRN)
@@ -87,6 +100,12 @@ class Pool(models.Model):
         self.name = name if name else ""
         self.renderNodes = []
         self.poolShares = WeakKeyDictionary()
+        # the rendernodes of this pool that can currently accept an assignment, kept up to date by the rendernodes
+        # and sorted by decreasing performance as a list of (-performance, id, rendernode) entries
+        self.availableRenderNodes = []
+        self.availableRenderNodesKeys = {}
+        # the rendernodes of this pool matching the requirements of a task, as (matcher, rendernodes) by task
+        self.matchingRenderNodes = WeakKeyDictionary()
 
     def archive(self):
         self.fireDestructionEvent(self)
@@ -99,6 +118,8 @@ class Pool(models.Model):
             rendernode.pools.append(self)
         if rendernode not in self.renderNodes:
             self.renderNodes.append(rendernode)
+        self.updateRenderNodeAvailability(rendernode)
+        self.invalidateMatchingRenderNodes()
         self.fireChangeEvent(self, "renderNodes", [], self.renderNodes)
 
     ## Removes a render node from the pool.
@@ -109,6 +130,8 @@ class Pool(models.Model):
             rendernode.pools.remove(self)
         if rendernode in self.renderNodes:
             self.renderNodes.remove(rendernode)
+        self._discardAvailableRenderNode(rendernode)
+        self.invalidateMatchingRenderNodes()
         self.fireChangeEvent(self, "renderNodes", [], self.renderNodes)
 
     ## Sets the rendernodes associated to this pool to the given list of rendernodes
@@ -119,10 +142,54 @@ class Pool(models.Model):
         for rendernode in renderNodes:
             self.addRenderNode(rendernode)
 
-    ## Returns an iterator for available rendernodes.
+    ## Adds, moves or removes the given rendernode in the list of available rendernodes.
+    # @param rendernode a rendernode of this pool whose status, commands or performance have changed
+    #
+    def updateRenderNodeAvailability(self, rendernode):
+        if rendernode.isAvailable():
+            key = (-rendernode.performance, rendernode.id)
+            if self.availableRenderNodesKeys.get(rendernode) == key:
+                return
+            self._discardAvailableRenderNode(rendernode)
+            self.availableRenderNodesKeys[rendernode] = key
+            insort(self.availableRenderNodes, key + (rendernode,))
+        else:
+            self._discardAvailableRenderNode(rendernode)
+
+    def _discardAvailableRenderNode(self, rendernode):
+        key = self.availableRenderNodesKeys.pop(rendernode, None)
+        if key is not None:
+            index = bisect_left(self.availableRenderNodes, key)
+            while self.availableRenderNodes[index][2] is not rendernode:
+                index += 1
+            del self.availableRenderNodes[index]
+
+    ## Returns True if at least one rendernode of this pool is available for command assignment.
+    #
+    def hasAvailableRenderNodes(self):
+        return bool(self.availableRenderNodes)
+
+    ## Returns the set of rendernodes of this pool whose caracteristics satisfy the requirements of the given task.
+    #
+    def getMatchingRenderNodes(self, task):
+        matcher = task.requirementsMatcher
+        cached = self.matchingRenderNodes.get(task)
+        if cached is None or cached[0] is not matcher:
+            cached = (matcher, frozenset(rendernode for rendernode in self.renderNodes if matcher.match(rendernode)))
+            self.matchingRenderNodes[task] = cached
+        return cached[1]
+
+    ## Forgets the requirements matches, after a change of the rendernodes or of their caracteristics.
+    #
+    def invalidateMatchingRenderNodes(self):
+        self.matchingRenderNodes.clear()
+
+    ## Returns an iterator for available rendernodes, by decreasing performance.
+    #
+    # The iterator walks the live list: stop iterating as soon as a rendernode availability is modified.
     #
     def getAvailableRenderNodesIterator(self):
-        return (rendernode for rendernode in self.renderNodes is rendernode.isAvailable())
+        return (rendernode for _, _, rendernode in self.availableRenderNodes)
 
     ## Returns a human readable representation of the pool.
     #
@@ -13,18 +13,24 @@ import httplib as http
 import time
 import logging
 import errno
-import requests
+import threading
 
+from octopus.core.communication.connectionpool import HTTPConnectionPool
 from octopus.dispatcher.model.enums import *
 from octopus.dispatcher import settings
 
 from . import models
 
 LOGGER = logging.getLogger('dispatcher.webservice')
-logging.getLogger('requests.packages.urllib3.connectionpool').setLevel(logging.WARNING)
 
 # set the status of a render node to RN_UNKNOWN after TIMEOUT seconds have elapsed since last update
 TIMEOUT = settings.RN_TIMEOUT
+# the ram in use reported by a render node is ignored after RAM_INFO_TIMEOUT seconds
+RAM_INFO_TIMEOUT = settings.RN_RAM_INFO_TIMEOUT
+# protects the creation of the connection pools of the render nodes
+CONNECTION_POOL_LOCK = threading.Lock()
+# the requests which can be sent again to a render node after a failure
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE'))
 
 
 ## This class represents the state of a RenderNode.
@@ -78,19 +84,62 @@ class RenderNode(models.Model):
         self.idInformed = False
         self.isRegistered = False
         self.lastAliveTime = 0
-        self.httpConnection = None
+        # ram in use reported by the worker with its sysinfos, and the time of the report
+        self.ramInUse = None
+        self.ramInUseTime = 0
+        self.connectionPool = None
+        # False once the worker has answered 404 to a batch assignment
+        self.supportsBatchAssignment = True
         self.caracteristics = caracteristics if caracteristics else {}
         self.currentpoolshare = None
+        # the poolshares through which the commands have been assigned, in packing mode
+        self.commandPoolShares = {}
         self.performance = float(performance)
 
         if not "softs" in self.caracteristics:
             self.caracteristics["softs"] = []
 
+    def __setattr__(self, name, value):
+        if name == 'caracteristics':
+            modified = self.__dict__.get('caracteristics') != value or not 'softs' in self.__dict__
+        super(RenderNode, self).__setattr__(name, value)
+        if name in ('status', 'isRegistered', 'commands', 'performance', 'freeCoresNumber'):
+            self.updateAvailability()
+        elif name == 'caracteristics' and modified:
+            self.updateCaracteristics()
+
     ## Returns True if this render node is available for command assignment.
     #
     def isAvailable(self):
+        if settings.RENDERNODE_PACKING:
+            # a rendernode running commands can receive more of them while it has free cores
+            return (self.isRegistered and self.status in (RN_IDLE, RN_ASSIGNED, RN_WORKING) and self.freeCoresNumber > 0)
         return (self.isRegistered and self.status == RN_IDLE and not self.commands)
 
+    ## Updates the lists of available rendernodes of the pools of this rendernode.
+    #
+    # Must be called whenever the status or the commands of this rendernode are modified in place.
+    #
+    def updateAvailability(self):
+        for pool in self.__dict__.get('pools', ()):
+            pool.updateRenderNodeAvailability(self)
+
+    ## Stores the ram in use reported by the worker in its sysinfos.
+    # @param ramInUse the ram currently in use on the render node, in MB
+    #
+    def setRamInUse(self, ramInUse):
+        self.ramInUse = float(ramInUse)
+        self.ramInUseTime = time.time()
+
+    ## Normalizes the caracteristics of this rendernode and resets the requirements matches of its pools.
+    #
+    # Must be called whenever the caracteristics of this rendernode are modified in place.
+    #
+    def updateCaracteristics(self):
+        super(RenderNode, self).__setattr__('softs', frozenset(self.caracteristics.get('softs', ())))
+        for pool in self.__dict__.get('pools', ()):
+            pool.invalidateMatchingRenderNodes()
+
     def reset(self, paused=False):
         # if paused, set the status to RN_PAUSED, else set it to Finishing, it will be set to IDLE in the next iteration of the dispatcher main loop
         if paused:
@@ -105,9 +154,7 @@ class RenderNode(models.Model):
             self.clearAssignment(cmd)
         self.commands = {}
         # reset the associated poolshare, if any
-        if self.currentpoolshare:
-            self.currentpoolshare.allocatedRN -= 1
-            self.currentpoolshare = None
+        self.releasePoolShares()
         # reset the values for cores and ram
         self.freeCoresNumber = int(self.coresNumber)
         self.usedCoresNumber = {}
@@ -124,9 +171,7 @@ class RenderNode(models.Model):
     def clearAssignment(self, command):
         '''Removes command from the list of commands assigned to this rendernode.'''
         # in case of failed assignment, decrement the allocatedRN value
-        if self.currentpoolshare:
-            self.currentpoolshare.allocatedRN -= 1
-            self.currentpoolshare = None
+        self.releasePoolShares(command)
         try:
             del self.commands[command.id]
         except KeyError:
@@ -134,17 +179,47 @@ class RenderNode(models.Model):
         else:
             self.releaseRessources(command)
             self.releaseLicense(command)
+            self.updateAvailability()
 
     ## Add a command assignment
     #
     def addAssignment(self, command):
         if not command.id in self.commands:
             self.commands[command.id] = command
+            self.updateAvailability()
             self.reserveRessources(command)
             # FIXME the assignment of the cmd should be done here and not in the dispatchIterator func
             command.assign(self)
             self.updateStatus()
 
+    ## Records that a command has been assigned to this rendernode through the given poolshare.
+    #
+    # In packing mode, a rendernode counts once in the allocatedRN of a poolshare whatever the
+    # number of commands it runs for it.
+    #
+    def addPoolShare(self, command, poolShare):
+        if settings.RENDERNODE_PACKING:
+            if poolShare not in self.commandPoolShares.values():
+                poolShare.allocatedRN += 1
+                poolShare.renderNodes.add(self)
+            self.commandPoolShares[command.id] = poolShare
+        else:
+            poolShare.allocatedRN += 1
+            self.currentpoolshare = poolShare
+
+    ## Releases the poolshare of the given command, or the poolshares of all the commands if None.
+    #
+    def releasePoolShares(self, command=None):
+        if self.currentpoolshare:
+            self.currentpoolshare.allocatedRN -= 1
+            self.currentpoolshare = None
+        commandIds = [command.id] if command is not None else self.commandPoolShares.keys()
+        for commandId in commandIds:
+            poolShare = self.commandPoolShares.pop(commandId, None)
+            if poolShare is not None and poolShare not in self.commandPoolShares.values():
+                poolShare.allocatedRN -= 1
+                poolShare.renderNodes.discard(self)
+
     ## Reserve license
     #
     def reserveLicense(self, command, licenseManager):
@@ -161,30 +236,50 @@ class RenderNode(models.Model):
         if lic and self.licenseManager:
             self.licenseManager.releaseLicenseForRenderNode(lic, self)
 
+    ## Returns the (cores, ram) to reserve on this rendernode for the given command.
+    #
+    # In packing mode, only the cores and ram requested by the task are reserved, so that the rest
+    # of the rendernode remains available. Otherwise the command takes the whole rendernode unless
+    # the task limits its number of cores or its ram.
+    #
+    def getRessourcesToReserve(self, command):
+        task = command.task
+        if settings.RENDERNODE_PACKING:
+            cores = min(self.freeCoresNumber, task.maxNbCores or task.minNbCores or self.freeCoresNumber)
+            ram = min(self.freeRam, task.ramUse)
+        else:
+            cores = min(self.freeCoresNumber, task.maxNbCores) or self.freeCoresNumber
+            ram = min(self.freeRam, task.ramUse) or self.freeRam
+        return cores, ram
+
+    ## Returns a sort key for the rendernodes able to run the given command, the best fit first.
+    #
+    # The best fit is the rendernode which will have the fewest free cores, then the least free ram,
+    # once the command is assigned to it.
+    #
+    def getPackingFit(self, command):
+        cores, ram = self.getRessourcesToReserve(command)
+        return (self.freeCoresNumber - cores, self.freeRam - ram)
+
     ## Reserve ressource
     #
     def reserveRessources(self, command):
-        res = min(self.freeCoresNumber, command.task.maxNbCores) or self.freeCoresNumber
-        self.usedCoresNumber[command.id] = res
-        self.freeCoresNumber -= res
+        cores, ram = self.getRessourcesToReserve(command)
+        self.usedCoresNumber[command.id] = cores
+        self.freeCoresNumber -= cores
 
-        res = min(self.freeRam, command.task.ramUse) or self.freeRam
-
-        self.usedRam[command.id] = res
-        self.freeRam -= res
+        self.usedRam[command.id] = ram
+        self.freeRam -= ram
 
     ## Release ressource
     #
     def releaseRessources(self, command):
-        #res = self.usedCoresNumber[command.id]
-        self.freeCoresNumber = self.coresNumber
-        if command.id in self.usedCoresNumber:
-            del self.usedCoresNumber[command.id]
+        # give back what the command had reserved, other commands may still run in packing mode
+        cores = self.usedCoresNumber.pop(command.id, 0)
+        self.freeCoresNumber = min(self.coresNumber, self.freeCoresNumber + cores)
 
-        #res = self.usedRam[command.id]
-        self.freeRam = self.ramSize
-        if command.id in self.usedRam:
-            del self.usedRam[command.id]
+        ram = self.usedRam.pop(command.id, 0)
+        self.freeRam = min(self.ramSize, self.freeRam + ram)
 
     ## Unassign a finished command
     #
@@ -220,9 +315,7 @@ class RenderNode(models.Model):
             if self.status not in (RN_IDLE, RN_PAUSED, RN_BOOTING):
                 #LOGGER.warning("rendernode %s was %d and is now IDLE." % (self.name, self.status))
                 self.status = RN_IDLE
-                if self.currentpoolshare:
-                    self.currentpoolshare.allocatedRN -= 1
-                    self.currentpoolshare = None
+                self.releasePoolShares()
             return
         commandStatus = [command.status for command in self.commands.values()]
         if CMD_RUNNING in commandStatus:
@@ -246,7 +339,9 @@ class RenderNode(models.Model):
     ## releases the finishing status of the rendernodes
     #
     def releaseFinishingStatus(self):
-        if self.status is RN_FINISHING:
+        packing = settings.RENDERNODE_PACKING
+        # in packing mode, a finished command has to be released even if others are still running
+        if self.status is RN_FINISHING or (packing and self.commands):
             #LOGGER.warning("Trying to release Finishing status for : %s, %s" % (self.name, self.status))
             # remove the commands that are in a final status
             for cmd in self.commands.values():
@@ -255,7 +350,9 @@ class RenderNode(models.Model):
                         cmd.completion = 1.0
                     cmd.finish()
                     self.unassign(cmd)
-            self.status = RN_IDLE
+            # the status of a rendernode still running commands has been updated by unassign
+            if not packing or not self.commands:
+                self.status = RN_IDLE
 
     ##
     #
@@ -263,20 +360,44 @@ class RenderNode(models.Model):
     #
     def getHTTPConnection(self):
         return http.HTTPConnection(self.host, self.port, timeout=20)
-#        if (self.httpConnection == None or
-#            self.httpConnection.port!=self.port or
-#            self.httpConnection.host!=self.host
-#        ):
-#            self.httpConnection = http.HTTPConnection(self.host, self.port)
-#        return self.httpConnection
+
+    ## Returns the pool of keep-alive connections to this render node.
+    #
+    # The pool is shared by all the threads sending requests to this render node.
+    #
+    def getConnectionPool(self):
+        with CONNECTION_POOL_LOCK:
+            pool = self.connectionPool
+            if pool is None or pool.host != self.host or pool.port != self.port:
+                if pool is not None:
+                    pool.close()
+                pool = HTTPConnectionPool(self.host, self.port,
+                                          maxSize=settings.RENDERNODE_CONNECTION_POOL_SIZE,
+                                          idleTimeout=settings.RENDERNODE_CONNECTION_IDLE_TIMEOUT,
+                                          timeout=20)
+                self.connectionPool = pool
+            return pool
+
+    ## Closes the connections to this render node that have been idle for too long.
+    #
+    def evictIdleConnections(self):
+        if self.connectionPool is not None:
+            self.connectionPool.evictIdleConnections()
 
     ## An exception class to report a render node http request failure.
     #
     class RequestFailed(Exception):
-        pass
+        def __init__(self, cause=None):
+            Exception.__init__(self, cause)
+            self.cause = cause
 
     ## Sends a HTTP request to the render node and returns a (HTTPResponse, data) tuple on success.
     #
+    # The request is sent on a keep-alive connection of the pool of this render node. If a reused
+    # connection turns out to be closed by the render node before it answers, the connection is
+    # dropped and the request is sent again at once on another one. The other failures of the
+    # requests which are not idempotent, such as POST, are not retried once the request has been
+    # sent: the render node may have received it already.
     # This method tries to send the request at most settings.RENDERNODE_REQUEST_MAX_RETRY_COUNT times,
     # waiting settings.RENDERNODE_REQUEST_DELAY_AFTER_REQUEST_FAILURE seconds between each try. It
     # then raises a RenderNode.RequestFailed exception.
@@ -294,32 +415,41 @@ class RenderNode(models.Model):
     def request(self, method, url, body=None, headers={}):
         from octopus.dispatcher import settings
 
-        conn = self.getHTTPConnection()
+        pool = self.getConnectionPool()
         # try to process the request at most RENDERNODE_REQUEST_MAX_RETRY_COUNT times.
         for i in xrange(settings.RENDERNODE_REQUEST_MAX_RETRY_COUNT):
+            conn, reused = pool.acquire()
+            reusable = sent = answered = False
             try:
                 conn.request(method, url, body, headers)
+                sent = True
                 response = conn.getresponse()
-                if response.length:
-                    data = response.read(response.length)
-                else:
-                    data = None
+                answered = True
+                # the whole body has to be read before the connection can be reused
+                data = response.read() or None
+                reusable = not response.will_close
                 # request succeeded
-                conn.close()
                 return (response, data)
             except http.socket.error, e:
-                try:
-                    conn.close()
-                except:
-                    pass
-                if e in (errno.ECONNREFUSED, errno.ENETUNREACH):
+                if e.errno in (errno.ECONNREFUSED, errno.ENETUNREACH):
                     raise self.RequestFailed(cause=e)
+                error = e
             except http.HTTPException, e:
-                try:
-                    conn.close()
-                except:
-                    pass
-                LOGGER.exception("rendernode.request failed")
+                if not reused:
+                    LOGGER.exception("rendernode.request failed")
+                error = e
+            finally:
+                pool.release(conn, reusable)
+            # a reused connection closed by the render node fails as soon as the answer is read
+            closed = reused and not answered and (isinstance(error, http.BadStatusLine) or
+                                                  getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE))
+            if not sent or closed:
+                if reused:
+                    # the request has not been processed, retry at once on another connection
+                    continue
+            elif method not in IDEMPOTENT_METHODS:
+                # the render node may have received the request, sending it again could run it twice
+                raise self.RequestFailed(cause=error)
             # request failed so let's sleep for a while
             time.sleep(settings.RENDERNODE_REQUEST_DELAY_AFTER_REQUEST_FAILURE)
         # request failed too many times so pause the RN and report a failure
@@ -327,53 +457,36 @@ class RenderNode(models.Model):
         raise self.RequestFailed()
 
     def canRun(self, command):
-        for (requirement, value) in command.task.requirements.items():
-            if requirement.lower() == "softs":  # todo
-                for soft in value:
-                    if not soft in self.caracteristics['softs']:
-                        return False
-            else:
-                if not requirement in self.caracteristics:
-                    return False
-                else:
-                    caracteristic = self.caracteristics[requirement]
-                    if type(caracteristic) != type(value) and not isinstance(value, list):
-                        return False
-                    if isinstance(value, list) and len(value) == 2:
-                        a, b = value
-                        if type(a) != type(b) or type(a) != type(caracteristic):
-                            return False
-                        try:
-                            if not (a < caracteristic < b):
-                                return False
-                        except ValueError:
-                            return False
-                    else:
-                        if isinstance(caracteristic, bool) and caracteristic != value:
-                            return False
-                        if isinstance(caracteristic, basestring) and caracteristic != value:
-                            return False
-                        if isinstance(caracteristic, int) and caracteristic < value:
-                            return False
+        if not command.task.requirementsMatcher.match(self):
+            return False
+        return self.hasEnoughRessources(command)
 
+    ## Returns True if the free cores and ram of this rendernode allow to run the given command.
+    #
+    def hasEnoughRessources(self, command):
+        packing = settings.RENDERNODE_PACKING
         if command.task.minNbCores:
             if self.freeCoresNumber < command.task.minNbCores:
                 return False
+        elif packing and command.task.maxNbCores:
+            if self.freeCoresNumber < command.task.maxNbCores:
+                return False
         else:
             if self.freeCoresNumber != self.coresNumber:
                 return False
 
         freeRam = self.ramSize
-        # if needed, ask the rendernode how much ram is currently in use
-        # to check whether we can launch the command or not
+        # if needed, check the ram in use last reported by the rendernode
+        # to know whether we can launch the command or not
         if command.task.ramUse != 0:
-            try:
-                r = requests.get("http://%s/ramInUse" % self.name, timeout=2)
-                if r.status_code == requests.codes.ok:
-                    freeRam = freeRam - float(r.text)
-            except requests.exceptions.Timeout:
-                LOGGER.warning("Timeout occured while trying to get ram in use on %s" % self.name)
-                return False
+            if self.ramInUse is not None and time.time() - self.ramInUseTime <= RAM_INFO_TIMEOUT:
+                freeRam = freeRam - self.ramInUse
+                if packing:
+                    # the last report may not include the commands assigned since
+                    freeRam = min(freeRam, self.freeRam)
+            else:
+                # no recent report, rely on the ram reserved by the commands assigned to this rendernode
+                freeRam = self.freeRam
 
         if freeRam < command.task.ramUse:
             LOGGER.warning("Not enough ram on %s. %d needed, %d avail." % (self.name, int(command.task.ramUse), int(freeRam)))
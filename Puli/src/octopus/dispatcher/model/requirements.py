@@ -0,0 +1,79 @@
+####################################################################################################
+# @file requirements.py
+# @package dispatcher.model
+# @author
+# @date 2014/05/12
+# @version 0.1
+#
+# This module compiles the requirements of a task into a matcher for the render nodes caracteristics.
+#
+####################################################################################################
+
+
+## Compiled form of the requirements dict of a task.
+#
+# The requirements are interpreted once, when the matcher is built. The "softs" requirement is turned
+# into a set, the other requirements into a list of checks on the render node caracteristics.
+#
+class RequirementsMatcher(object):
+
+    def __init__(self, requirements):
+        softs = set()
+        self.checks = []
+        for (requirement, value) in dict(requirements or {}).items():
+            if requirement.lower() == "softs":
+                softs.update(value)
+            else:
+                self.checks.append(self.compileRequirement(requirement, value))
+        self.softs = frozenset(softs)
+
+    ## Returns a function checking the given requirement against a caracteristics dict.
+    #
+    @staticmethod
+    def compileRequirement(requirement, value):
+        if isinstance(value, list) and len(value) == 2:
+            a, b = value
+            if type(a) != type(b):
+                return lambda caracteristics: False
+            boundsType = type(a)
+
+            def check(caracteristics):
+                if not requirement in caracteristics:
+                    return False
+                caracteristic = caracteristics[requirement]
+                if type(caracteristic) != boundsType:
+                    return False
+                try:
+                    return a < caracteristic < b
+                except ValueError:
+                    return False
+            return check
+
+        valueType = type(value)
+        isList = isinstance(value, list)
+
+        def check(caracteristics):
+            if not requirement in caracteristics:
+                return False
+            caracteristic = caracteristics[requirement]
+            if type(caracteristic) != valueType and not isList:
+                return False
+            if isinstance(caracteristic, bool) and caracteristic != value:
+                return False
+            if isinstance(caracteristic, basestring) and caracteristic != value:
+                return False
+            if isinstance(caracteristic, int) and caracteristic < value:
+                return False
+            return True
+        return check
+
+    ## Returns True if the given render node satisfies these requirements.
+    #
+    def match(self, rendernode):
+        if not self.softs <= rendernode.softs:
+            return False
+        caracteristics = rendernode.caracteristics
+        for check in self.checks:
+            if not check(caracteristics):
+                return False
+        return True
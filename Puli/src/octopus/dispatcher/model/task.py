@@ -1,7 +1,13 @@
 from .models import (Model, StringField, ModelField, DictField, IntegerField, FloatField,
                      ModelListField, ModelDictField)
-from .enums import NODE_BLOCKED, NODE_CANCELED, NODE_DONE, NODE_ERROR, NODE_PAUSED, NODE_READY, NODE_RUNNING
-from collections import defaultdict
+from .enums import NODE_BLOCKED, NODE_CANCELED, NODE_DONE, NODE_ERROR, NODE_PAUSED, NODE_READY, NODE_RUNNING, CMD_READY
+from .requirements import RequirementsMatcher
+from .aggregate import Aggregate
+from .command import Command
+from heapq import heappush, heappop
+
+# the fields of a task or taskgroup which are aggregated by its parent
+AGGREGATED_FIELDS = frozenset(('status', 'completion'))
 
 
 class TaskGroup(Model):
@@ -27,6 +33,10 @@ class TaskGroup(Model):
     def __init__(self, id, name, parent, user, arguments, environment, requirements,
                  maxRN, priority, dispatchKey, strategy, nodes={}, tags={}):
         Model.__init__(self)
+        self.aggregate = Aggregate()
+        # the tasks whose changes have not been aggregated yet
+        self.dirtyTasks = set()
+        self.invalidated = True
         self.id = int(id) if id else None
         self.name = str(name)
         self.parent = parent
@@ -49,44 +59,70 @@ class TaskGroup(Model):
         self.updateTime = None
         self.endTime = None
 
+    def __setattr__(self, name, value):
+        setAggregatedAttribute(self, name, value)
+
     def addTask(self, task):
         assert isinstance(task, Task) or isinstance(task, TaskGroup)
         self.tasks.append(task)
+        self.aggregate.add(task)
+        self.invalidate(task)
 
     def removeTask(self, task):
         self.tasks.remove(task)
+        self.aggregate.remove(task)
+        self.invalidate()
 
     def archive(self):
         self.fireDestructionEvent(self)
 
+    ## Marks this taskgroup and its ancestors as needing an update of their status and completion.
+    #
+    # @param task the task or taskgroup whose change must be aggregated, if any
+    #
+    def invalidate(self, task=None):
+        if task is not None:
+            self.dirtyTasks.add(task)
+        taskGroup = self
+        while not taskGroup.invalidated:
+            taskGroup.invalidated = True
+            if taskGroup.parent is None:
+                break
+            taskGroup.parent.dirtyTasks.add(taskGroup)
+            taskGroup = taskGroup.parent
+
     def updateStatusAndCompletion(self):
+        if not self.invalidated:
+            return
+        # only the child taskgroups which have changed since the last update are visited
+        for child in list(self.dirtyTasks):
+            if isinstance(child, TaskGroup) and child.parent is self:
+                child.updateStatusAndCompletion()
+        dirtyTasks, self.dirtyTasks = self.dirtyTasks, set()
+        for child in dirtyTasks:
+            self.aggregate.refresh(child)
+        aggregate = self.aggregate
         if not self.tasks:
             self.completion = 1.0
             self.status = NODE_DONE
         else:
-            completion = 0.0
-            status = defaultdict(int)
-            for child in self.tasks:
-                if isinstance(child, TaskGroup):
-                    child.updateStatusAndCompletion()
-                completion += child.completion
-                status[child.status] += 1
-            self.completion = completion / len(self.tasks)
-
-            if NODE_PAUSED in status:
+            self.completion = aggregate.completion
+
+            if aggregate.hasStatus(NODE_PAUSED):
                 self.status = NODE_PAUSED
-            elif NODE_RUNNING in status:
+            elif aggregate.hasStatus(NODE_RUNNING):
                 self.status = NODE_RUNNING
-            elif NODE_ERROR in status:
+            elif aggregate.hasStatus(NODE_ERROR):
                 self.status = NODE_ERROR
-            elif NODE_CANCELED in status:
+            elif aggregate.hasStatus(NODE_CANCELED):
                 self.status = NODE_CANCELED
-            elif NODE_READY in status or self.completion != 1.0:
+            elif aggregate.hasStatus(NODE_READY) or self.completion != 1.0:
                 self.status = NODE_READY
-            elif NODE_BLOCKED in status:
+            elif aggregate.hasStatus(NODE_BLOCKED):
                 self.status = NODE_BLOCKED
             else:
                 self.status = NODE_DONE
+        self.invalidated = False
 
     def __iter__(self):
         return iter(self.tasks)
@@ -147,6 +183,50 @@ class Task(Model):
         self.startTime = None
         self.updateTime = None
         self.endTime = None
+        # heap of (id, command) for the commands that have been set ready, outdated entries are dropped lazily
+        self.readyCommands = []
+        self.readyCommandIds = set()
+
+    def __setattr__(self, name, value):
+        setAggregatedAttribute(self, name, value)
+        if name == 'requirements':
+            # the requirements are compiled once, they must not be modified in place
+            Model.__setattr__(self, 'requirementsMatcher', RequirementsMatcher(value))
+
+    ## Sets the status of several commands of this task at once.
+    #
+    # The change events of the commands are delivered as one bulk event, so that the
+    # listeners can handle them in a single pass.
+    #
+    def setCommandsStatus(self, commands, status):
+        if not commands:
+            return
+        with Command.suppressedChangeEvents():
+            for command in commands:
+                command.status = status
+
+    ## Registers a command of this task that has been set ready.
+    #
+    def addReadyCommand(self, command):
+        if command.id not in self.readyCommandIds:
+            self.readyCommandIds.add(command.id)
+            heappush(self.readyCommands, (command.id, command))
+
+    ## Yields the ready commands of this task in the order they arrived.
+    #
+    # The iteration stops if a yielded command is still ready when the next one is requested.
+    #
+    def iterReadyCommands(self):
+        readyCommands = self.readyCommands
+        while readyCommands:
+            commandId, command = readyCommands[0]
+            if command.status != CMD_READY or command.task is not self:
+                heappop(readyCommands)
+                self.readyCommandIds.discard(commandId)
+                continue
+            yield command
+            if command.status == CMD_READY:
+                return
 
     def addValidationExpression(self, validationExpression):
         self.validationExpression = "&".join(self.validationExpression,
@@ -168,6 +248,19 @@ class Task(Model):
                                                              self.lic)
 
 
+## Sets an attribute of a task or taskgroup, invalidating its parent if an aggregated field changes.
+#
+def setAggregatedAttribute(task, name, value):
+    if name in AGGREGATED_FIELDS:
+        oldvalue = task.__dict__.get(name)
+        Model.__setattr__(task, name, value)
+        parent = task.__dict__.get('parent')
+        if oldvalue != value and parent is not None:
+            parent.invalidate(task)
+    else:
+        Model.__setattr__(task, name, value)
+
+
 class TaskListener(object):
 
     def __init__(self):
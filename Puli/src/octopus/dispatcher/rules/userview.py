@@ -44,9 +44,9 @@ class UserView(object):
         if task.parent:
             return (task.parent.nodes[RULENAME], False)
         userName = task.user
-        for child in self.root.children:
-            if child.name == userName:
-                return (child, False)
+        child = self.root.getChildByName(userName)
+        if child is not None:
+            return (child, False)
         userNode = FolderNode(None, userName, self.root, userName, 1, 1.0, -1, FifoStrategy(), None)
         return (userNode, True)
 
@@ -0,0 +1,361 @@
+####################################################################################################
+# @file snapshot.py
+# @package octopus.dispatcher
+# @author
+# @date 2014/05/26
+# @version 0.1
+#
+# This module provides the read-only snapshot of the serialized model which is published at the end
+# of each dispatch cycle, so that the webservice can answer the GET requests without waiting for the
+# main loop, and the journal of the changes between the snapshots.
+#
+####################################################################################################
+
+import time
+import logging
+import threading
+import collections
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from octopus.dispatcher import settings
+from octopus.dispatcher.model import models
+from octopus.dispatcher.model.node import BaseNode
+from octopus.dispatcher.model.task import Task, TaskGroup
+from octopus.dispatcher.model.command import Command
+from octopus.dispatcher.model.rendernode import RenderNode
+from octopus.dispatcher.model.pool import Pool, PoolShare
+
+LOGGER = logging.getLogger('dispatcher.snapshot')
+
+# number of consecutive integer keys stored in the same bucket of a SnapshotTable
+BUCKET_SIZE = 64
+
+
+## Serialized representation of an object, encoded to JSON on first use.
+#
+# The entries are shared by the successive snapshots until their object changes, so an object is
+# encoded at most once between two of its changes.
+#
+class SnapshotEntry(object):
+
+    __slots__ = ('data', '_encoded')
+
+    def __init__(self, data):
+        self.data = data
+        self._encoded = None
+
+    @property
+    def encoded(self):
+        if self._encoded is None:
+            self._encoded = json.dumps(self.data)
+        return self._encoded
+
+
+## Returns the JSON array of the given encoded objects.
+#
+def joinEncoded(fragments):
+    return '[%s]' % ', '.join(fragments)
+
+
+## Immutable mapping of keys to serialized objects.
+#
+# The entries are split into buckets, so that the table built from this one by update() only copies
+# the buckets containing a changed entry and shares the other ones.
+#
+class SnapshotTable(object):
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets if buckets is not None else {}
+
+    @staticmethod
+    def bucketIndex(key):
+        if isinstance(key, (int, long)):
+            return key // BUCKET_SIZE
+        # the non integer keys are kept apart from the integer ones
+        return ('hash', hash(key) % BUCKET_SIZE)
+
+    def getEntry(self, key):
+        bucket = self.buckets.get(self.bucketIndex(key))
+        if bucket is None:
+            return None
+        return bucket.get(key)
+
+    def get(self, key, default=None):
+        entry = self.getEntry(key)
+        return entry.data if entry is not None else default
+
+    ## Returns the JSON representation of the object with the given key, or None.
+    #
+    def getEncoded(self, key):
+        entry = self.getEntry(key)
+        return entry.encoded if entry is not None else None
+
+    def __contains__(self, key):
+        bucket = self.buckets.get(self.bucketIndex(key))
+        return bucket is not None and key in bucket
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def entries(self):
+        return [entry for bucket in self.buckets.itervalues() for entry in bucket.itervalues()]
+
+    def values(self):
+        return [entry.data for entry in self.entries()]
+
+    ## Returns the JSON array of all the objects of the table.
+    #
+    def encodedValues(self):
+        return joinEncoded(entry.encoded for entry in self.entries())
+
+    ## Returns a new table with the given changes, a dict of key -> serialized object, None removing the key.
+    #
+    def update(self, changes):
+        if not changes:
+            return self
+        buckets = dict(self.buckets)
+        copied = set()
+        for key, value in changes.iteritems():
+            index = self.bucketIndex(key)
+            if index not in copied:
+                buckets[index] = dict(buckets.get(index, ()))
+                copied.add(index)
+            if value is None:
+                buckets[index].pop(key, None)
+            else:
+                buckets[index][key] = SnapshotEntry(value)
+        for index in copied:
+            if not buckets[index]:
+                del buckets[index]
+        return SnapshotTable(buckets)
+
+
+## Bounded journal of the keys of the objects changed by each version of the model.
+#
+# The oldest versions are dropped when more than size object changes are recorded, the changes
+# since a dropped version are then unknown.
+#
+class ChangeJournal(object):
+
+    def __init__(self, size, version):
+        self.size = size
+        # the changes made after oldestVersion are all recorded
+        self.oldestVersion = version
+        self.records = collections.deque()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    ## Records the changes of a version, a dict of table name -> changed keys.
+    #
+    def record(self, version, changes):
+        with self.lock:
+            for name, keys in changes.iteritems():
+                if keys:
+                    self.records.append((version, name, frozenset(keys)))
+                    self.count += len(keys)
+            while self.count > self.size and self.records:
+                droppedVersion, name, keys = self.records.popleft()
+                self.count -= len(keys)
+                self.oldestVersion = droppedVersion
+
+    ## Returns the keys of the given table changed after version since up to version until,
+    #  or None if they are not all recorded anymore.
+    #
+    def changesSince(self, name, since, until):
+        with self.lock:
+            if since < self.oldestVersion:
+                return None
+            changed = set()
+            for version, recordName, keys in self.records:
+                if since < version <= until and recordName == name:
+                    changed.update(keys)
+            return changed
+
+
+## Serialized state of the model at the end of a dispatch cycle.
+#
+# The nodes, tasks and commands are indexed by id, the rendernodes and pools by name.
+#
+class Snapshot(object):
+
+    def __init__(self, cycle, version, journal, nodes, tasks, commands, renderNodes, pools):
+        self.cycle = cycle
+        self.version = version
+        self.journal = journal
+        self.time = time.time()
+        self.nodes = nodes
+        self.tasks = tasks
+        self.commands = commands
+        self.renderNodes = renderNodes
+        self.pools = pools
+
+    @property
+    def age(self):
+        return time.time() - self.time
+
+    ## Returns the JSON representation of the objects of a table created, changed or removed since
+    #  the given version of the model.
+    #
+    # The response lists the representations of the objects created or changed under the given
+    # key, the keys of the removed objects, and the version of this snapshot to use as the next
+    # since value. When the changes are not known anymore, or the version is not one of this
+    # dispatcher, resync is true and all the objects are listed.
+    #
+    # @param name the name of the table (nodes, tasks, commands, renderNodes or pools)
+    # @param key the key of the objects in the response
+    # @param since the last version of the model known by the client
+    # @param accept an optional predicate selecting the objects to list from their serialized data
+    #
+    def encodedChanges(self, name, key, since, accept=None):
+        changes = self.changesSince(name, since)
+        if changes is None:
+            entries, removed = getattr(self, name).entries(), []
+        else:
+            entries, removed = changes
+        if accept is not None:
+            entries = [entry for entry in entries if accept(entry.data)]
+        return '{"version": %d, "since": %d, "resync": %s, "%s": %s, "removed": %s}' % (
+            self.version, since, 'true' if changes is None else 'false', key,
+            joinEncoded(entry.encoded for entry in entries), json.dumps(removed))
+
+    ## Returns the entries of a table created or changed since the given version and the keys of the
+    #  removed objects, or None if these changes are not known.
+    #
+    def changesSince(self, name, since):
+        if since > self.version:
+            return None
+        changed = self.journal.changesSince(name, since, self.version)
+        if changed is None:
+            return None
+        table = getattr(self, name)
+        entries, removed = [], []
+        for key in changed:
+            entry = table.getEntry(key)
+            if entry is None:
+                removed.append(key)
+            else:
+                entries.append(entry)
+        return entries, removed
+
+
+## Builds the snapshots from the objects of the dispatch tree.
+#
+# The objects are marked as changed by the model events, by the database element lists of the
+# tree and by markChanged(), only the changed objects are serialized again when a snapshot is published.
+#
+class SnapshotBuilder(object):
+
+    def __init__(self, dispatchTree):
+        self.dispatchTree = dispatchTree
+        self.changed = set()
+        self.snapshot = None
+        # the versions start from the start time in milliseconds, so that they keep increasing
+        # when the dispatcher is restarted and the clients do not mistake older versions for recent ones
+        self.version = int(time.time() * 1000)
+        self.journal = ChangeJournal(settings.CHANGE_JOURNAL_SIZE, self.version)
+        # callables receiving each published snapshot, in the thread of the main loop
+        self.listeners = []
+        models.Model.changeListeners.append(self)
+
+    def destroy(self):
+        models.Model.changeListeners.remove(self)
+
+    def onCreationEvent(self, obj):
+        self.markChanged(obj)
+
+    def onDestructionEvent(self, obj):
+        self.markChanged(obj)
+
+    def onChangeEvent(self, obj, field, oldvalue, newvalue):
+        self.changed.add(obj)
+        if field == 'parent':
+            # the parents list the ids of their children
+            if oldvalue is not None:
+                self.changed.add(oldvalue)
+            if newvalue is not None:
+                self.changed.add(newvalue)
+
+    ## Marks an object whose representation has changed without any model event, for
+    #  example after a change of one of its lists or dicts.
+    #
+    def markChanged(self, obj):
+        self.changed.add(obj)
+        parent = getattr(obj, 'parent', None)
+        if isinstance(parent, models.Model):
+            self.changed.add(parent)
+
+    ## Marks the elements of the database lists of the tree, which are cleared once saved.
+    #
+    def markDbElementsChanged(self):
+        tree = self.dispatchTree
+        for elements in (tree.toCreateElements, tree.toModifyElements, tree.toArchiveElements):
+            for element in elements:
+                self.markChanged(element)
+
+    def markTreeChanged(self):
+        tree = self.dispatchTree
+        for objects in (tree.nodes.values(), tree.tasks.values(), tree.commands.values(),
+                        tree.renderNodes.values(), tree.pools.values()):
+            self.changed.update(objects)
+
+    ## Serializes the changed objects and returns the new snapshot.
+    #
+    def publish(self, cycle):
+        tree = self.dispatchTree
+        if self.snapshot is None:
+            self.markTreeChanged()
+            previous = Snapshot(cycle, self.version, self.journal, *([SnapshotTable()] * 5))
+        else:
+            previous = self.snapshot
+        changed, self.changed = self.changed, set()
+        nodes, tasks, commands, renderNodes, pools = {}, {}, {}, {}, {}
+        for obj in changed:
+            if isinstance(obj, BaseNode):
+                self.serialize(obj, obj.id, tree.nodes, nodes)
+            elif isinstance(obj, Command):
+                self.serialize(obj, obj.id, tree.commands, commands)
+            elif isinstance(obj, (Task, TaskGroup)):
+                self.serialize(obj, obj.id, tree.tasks, tasks)
+            elif isinstance(obj, RenderNode):
+                self.serialize(obj, obj.name, tree.renderNodes, renderNodes)
+            elif isinstance(obj, Pool):
+                self.serialize(obj, obj.name, tree.pools, pools)
+            elif isinstance(obj, PoolShare):
+                # the poolshares are listed by their node and pool
+                for owner in (obj.node, obj.pool):
+                    if isinstance(owner, BaseNode):
+                        self.serialize(owner, owner.id, tree.nodes, nodes)
+                    elif isinstance(owner, Pool):
+                        self.serialize(owner, owner.name, tree.pools, pools)
+        changes = {'nodes': nodes, 'tasks': tasks, 'commands': commands, 'renderNodes': renderNodes, 'pools': pools}
+        if self.snapshot is not None and any(changes.itervalues()):
+            self.version += 1
+            self.journal.record(self.version, changes)
+        self.snapshot = Snapshot(cycle, self.version, self.journal,
+                                 previous.nodes.update(nodes),
+                                 previous.tasks.update(tasks),
+                                 previous.commands.update(commands),
+                                 previous.renderNodes.update(renderNodes),
+                                 previous.pools.update(pools))
+        for listener in self.listeners:
+            try:
+                listener(self.snapshot)
+            except Exception:
+                LOGGER.exception("error while running snapshot listener")
+        return self.snapshot
+
+    def serialize(self, obj, key, index, changes):
+        if key is None:
+            # not registered in the tree yet, the change of its id will mark it again
+            return
+        if index.get(key) is not obj:
+            changes[key] = None
+            return
+        try:
+            changes[key] = obj.to_json()
+        except Exception:
+            LOGGER.exception("cannot serialize %r", obj)
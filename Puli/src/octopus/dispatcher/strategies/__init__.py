@@ -11,18 +11,31 @@
 # - FairStrategy, a strategy that shares "fairly" the allocated render nodes to the children;
 # - WeighedFairStrategy, a strategy similar to the FairStrategy but giving fewer render nodes to
 #                        the children with higher dispatchKeys;
-# - PriorityStrategy, a strategy that gives the nodes to the children with the highest priority.
+# - PriorityStrategy, a strategy that gives the nodes to the children with the highest priority;
+# - ShortestJobFirstStrategy, a strategy that gives the nodes to the children with the least
+#                             expected remaining work first.
 #
 # To define a new strategy, you have to write a class that implements two methods:
 # - update(self, folder, entrypoint) -> sorts the folder's children according to the strategy
 # - on_assignment(self, folder, task, rendernode) -> called after a rendernode has been assigned
 #                                                    to a child or descendant of the folder.
 #
+# The strategies ordering the children by a key can instead extend HeapStrategy and implement:
+# - key(self, child) -> the sort key of a child, the children with the lowest keys come first.
+# The children are then kept in a heap per folder, which is updated when a child is added, removed
+# or assigned a rendernode, instead of sorting all the children each time the folder is dispatched.
+# The children without ready commands and the paused ones are left out of the heap until they
+# can be dispatched again.
+#
 ####################################################################################################
 
 __all__ = ['loadStrategyClass', 'createStrategyInstance']
 
 from collections import defaultdict
+from heapq import heapify, heappush, heappop
+from weakref import WeakKeyDictionary
+
+from octopus.dispatcher import settings
 
 
 class BaseStrategy(object):
@@ -36,18 +49,106 @@ class BaseStrategy(object):
     def on_assignment(self, folder, task, node):
         raise NotImplementedError
 
+    def on_child_change(self, folder, child):
+        '''Called when a child is added to or removed from the folder, or when its priority, ready command count,
+        time by frame or paused state changes.'''
+        pass
+
+    def children(self, folder, entrypoint):
+        '''Returns the children of the folder in the order they must be dispatched.'''
+        self.update(folder, entrypoint)
+        return list(folder.children)
+
     def getClassName(self):
         return self.__module__ + "." + self.__class__.__name__
 
 
-class FifoStrategy(BaseStrategy):
+def isDispatchable(child):
+    '''Returns False if the child has no command to dispatch, it is then left out of the heaps.'''
+    return child.readyCommandCount > 0 and not getattr(child, 'paused', False)
+
+
+class ChildrenHeap(object):
+    '''
+    Heap of (key, child) entries for the dispatchable children of a folder.
+
+    The changes of the children are recorded and applied on the next call to refresh(): a changed
+    child gets a new entry, or none if it cannot be dispatched, and its former entry is left in the
+    heap, it is skipped when met.
+    '''
+
+    def __init__(self, folder, key):
+        self.entries = dict((child, (key(child), child)) for child in folder.children if isDispatchable(child))
+        self.heap = self.entries.values()
+        heapify(self.heap)
+        self.changed = set()
+
+    def refresh(self, folder, key):
+        for child in self.changed:
+            if child.parent is folder and isDispatchable(child):
+                entry = (key(child), child)
+                self.entries[child] = entry
+                heappush(self.heap, entry)
+            else:
+                self.entries.pop(child, None)
+        self.changed.clear()
+        if len(self.heap) > 2 * len(self.entries) + 16:
+            # too many outdated entries
+            self.heap = self.entries.values()
+            heapify(self.heap)
+
+    def __iter__(self):
+        '''Yields the children by increasing key, without modifying the heap.'''
+        heap = self.heap
+        entries = self.entries
+        size = len(heap)
+        # the heap positions that can hold the next smallest entry
+        candidates = [(heap[0], 0)] if heap else []
+        while candidates:
+            entry, index = heappop(candidates)
+            for childIndex in (2 * index + 1, 2 * index + 2):
+                if childIndex < size:
+                    heappush(candidates, (heap[childIndex], childIndex))
+            if entries.get(entry[1]) is entry:
+                yield entry[1]
+
+
+class HeapStrategy(BaseStrategy):
+    '''
+    Base class for the strategies ordering the children of a folder by a key.
+    '''
+
+    def __init__(self):
+        self.childrenHeaps = WeakKeyDictionary()
+
+    def key(self, child):
+        raise NotImplementedError
 
     def update(self, folder, ep):
-        folder.children.sort(key=lambda child: child.id)
+        folder.children.sort(key=self.key)
+
+    def children(self, folder, ep):
+        childrenHeap = self.childrenHeaps.get(folder)
+        if childrenHeap is None:
+            childrenHeap = self.childrenHeaps[folder] = ChildrenHeap(folder, self.key)
+        else:
+            childrenHeap.refresh(folder, self.key)
+        return iter(childrenHeap)
 
     def on_assignment(self, folder, task, node):
         pass
 
+    def on_child_change(self, folder, child):
+        childrenHeap = self.childrenHeaps.get(folder)
+        if childrenHeap is not None:
+            childrenHeap.changed.add(child)
+
+
+class FifoStrategy(HeapStrategy):
+
+    def key(self, child):
+        return child.id
+
     def __str__(self):
         return "FairStrategy"
 
@@ -64,71 +165,109 @@ class AsIsStrategy(BaseStrategy):
         return "AsIsStrategy"
 
 
-class FairStrategy(BaseStrategy):
+class FairStrategy(HeapStrategy):
 
     def __init__(self):
+        HeapStrategy.__init__(self)
         self.assignment_counts = defaultdict(int)
 
-    def update(self, folder, ep):
-        folder.children.sort(self.cmp)
-
-    def cmp(self, x, y):
-        countx = self.assignment_counts[x]
-        county = self.assignment_counts[y]
-        val = cmp(countx, county)
-        if val == 0:
-            return cmp(x.id, y.id)
-        else:
-            return val
+    def key(self, child):
+        return (self.assignment_counts[child], child.id)
 
     def on_assignment(self, folder, task, node):
         self.assignment_counts[task] += 1
+        self.on_child_change(folder, task)
 
     def __str__(self):
         return "FairStrategy"
 
 
-class WeighedFairStrategy(BaseStrategy):
+class WeighedFairStrategy(HeapStrategy):
 
     def __init__(self):
+        HeapStrategy.__init__(self)
         self.assignment_counts = defaultdict(int)
 
-    def update(self, folder, ep):
-        folder.children.sort(self.cmp)
-
-    def cmp(self, x, y):
-        countx = self.assignment_counts[x]
-        county = self.assignment_counts[y]
-        val = cmp(countx, county)
-        if val == 0:
-            return cmp(x.id, y.id)
-        else:
-            return val
+    def key(self, child):
+        return (self.assignment_counts[child], child.id)
 
     def on_assignment(self, folder, task, node):
         self.assignment_counts[task] += task.dispatchKey
+        self.on_child_change(folder, task)
 
     def __str__(self):
         return "WeighedFairStrategy"
 
 
-class PriorityStrategy(BaseStrategy):
+class PriorityStrategy(HeapStrategy):
 
-    def update(self, folder, ep):
-        folder.children.sort(self.cmp)
+    def key(self, child):
+        return (-child.priority, child.id)
 
-    def cmp(self, x, y):
-        priocmp = cmp(y.priority, x.priority)
-        if priocmp:
-            return priocmp
-        else:
-            return cmp(x.id, y.id)
+    def __str__(self):
+        return "PriorityStrategy"
+
+
+class ShortestJobFirstStrategy(HeapStrategy):
+    '''
+    Orders the children by expected remaining work: the frames of their ready commands multiplied by
+    their average time by frame.
+
+    Until a node has a measured time by frame, the last time measured for a task of the same runner
+    is used, then the RUNNER_TIME_BY_FRAME and DEFAULT_TIME_BY_FRAME settings.
+    The key of a child is computed again when it is assigned a rendernode, and when its ready command
+    count or time by frame changes, but not when a time is measured for another task of its runner.
+    '''
+
+    # last average time by frame measured for each runner, shared by all the instances
+    runnerTimeByFrame = {}
+
+    @classmethod
+    def recordTimeByFrame(cls, runner, timeByFrame):
+        '''Records the average time by frame measured for a task of the given runner.'''
+        cls.runnerTimeByFrame[runner] = timeByFrame
+
+    def __init__(self):
+        HeapStrategy.__init__(self)
+        # task -> (number of commands, average number of frames by command)
+        self.taskFramesByCommand = WeakKeyDictionary()
+
+    def key(self, child):
+        return (self.expectedWork(child), child.id)
 
     def on_assignment(self, folder, task, node):
-        pass
+        self.on_child_change(folder, task)
+
+    def expectedWork(self, node):
+        if not node.readyCommandCount:
+            return 0.0
+        children = getattr(node, 'children', None)
+        if children is not None:
+            return sum(self.expectedWork(child) for child in children)
+        return node.readyCommandCount * self.framesByCommand(node.task) * self.timeByFrame(node)
+
+    def framesByCommand(self, task):
+        commandCount, framesByCommand = self.taskFramesByCommand.get(task, (None, None))
+        if commandCount != len(task.commands):
+            commandCount = len(task.commands)
+            if commandCount:
+                framesByCommand = float(sum(max(command.nbFrames, 1) for command in task.commands)) / commandCount
+            else:
+                framesByCommand = 1.0
+            self.taskFramesByCommand[task] = (commandCount, framesByCommand)
+        return framesByCommand
+
+    def timeByFrame(self, node):
+        if node.averageTimeByFrame:
+            return node.averageTimeByFrame
+        runner = node.task.runner
+        try:
+            return self.runnerTimeByFrame[runner]
+        except KeyError:
+            return settings.RUNNER_TIME_BY_FRAME.get(runner, settings.DEFAULT_TIME_BY_FRAME)
 
     def __str__(self):
-        return "PriorityStrategy"
+        return "ShortestJobFirstStrategy"
 
 
 class StrategyImportError(ImportError):
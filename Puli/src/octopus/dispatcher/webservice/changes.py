@@ -0,0 +1,236 @@
+####################################################################################################
+# @file changes.py
+# @package octopus.dispatcher.webservice
+# @author
+# @date 2014/06/02
+# @version 0.1
+#
+# This module provides the stream of the changes of the model, pushed to the dashboards as
+# server-sent events at the end of each dispatch cycle.
+#
+####################################################################################################
+
+import time
+import logging
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from tornado.web import asynchronous
+from tornado.ioloop import IOLoop
+
+from octopus.core.framework import BaseResource
+from octopus.core.communication.http import Http400
+from octopus.dispatcher import settings
+from octopus.dispatcher.snapshot import joinEncoded
+
+__all__ = ['ChangeStream', 'ChangeStreamResource']
+
+LOGGER = logging.getLogger("dispatcher.webservice")
+
+# the object types of the stream, and the snapshot tables holding them
+TYPES = (('nodes', 'nodes'), ('tasks', 'tasks'), ('commands', 'commands'), ('rendernodes', 'renderNodes'), ('pools', 'pools'))
+
+
+## Selects the objects of the stream of a client.
+#
+# The user filter applies to the nodes, tasks and commands, the node filter to the nodes of the
+# subtree of the given node and their tasks and commands, and the pool filter to the nodes under
+# a poolshare of the pool, their tasks and commands, and the rendernodes of the pool. The removed
+# objects are not filtered.
+#
+class ChangeFilter(object):
+
+    def __init__(self, types=None, pool=None, user=None, node=None):
+        self.types = frozenset(types) if types else frozenset(key for key, name in TYPES)
+        self.pool = pool
+        self.user = user
+        self.node = node
+
+    def accepts(self, snapshot, key, data):
+        if key == 'nodes':
+            return self.acceptsNode(snapshot, data)
+        elif key == 'tasks':
+            return self.acceptsTask(snapshot, data)
+        elif key == 'commands':
+            task = snapshot.tasks.get(data['task'])
+            return task is not None and self.acceptsTask(snapshot, task)
+        elif key == 'rendernodes':
+            return self.pool is None or self.pool in data['pools']
+        elif key == 'pools':
+            return self.pool is None or self.pool == data['name']
+        return True
+
+    def acceptsTask(self, snapshot, task):
+        if self.user is not None and task['user'] != self.user:
+            return False
+        if self.node is None and self.pool is None:
+            return True
+        for nodeId in task.get('nodes', ()):
+            node = snapshot.nodes.get(nodeId)
+            if node is not None and self.acceptsNode(snapshot, node):
+                return True
+        return False
+
+    def acceptsNode(self, snapshot, node):
+        if self.user is not None and node['user'] != self.user:
+            return False
+        inSubtree = self.node is None
+        inPool = self.pool is None
+        while node is not None and not (inSubtree and inPool):
+            if node['id'] == self.node:
+                inSubtree = True
+            if not inPool and any(poolName == self.pool for (poolShareId, poolName) in node['poolShares']):
+                inPool = True
+            node = snapshot.nodes.get(node['parent'])
+        return inSubtree and inPool
+
+
+## Pushes the changes of each snapshot published by the main loop to the connected clients.
+#
+# A client is sent at most one batch at a time: the changes published while its last batch is
+# being written are merged into the next one. A client which has not read its last batch after
+# CHANGE_STREAM_TIMEOUT seconds is disconnected, and a batch larger than CHANGE_STREAM_BUFFER_SIZE
+# is replaced by a resync event telling the client to get the objects from the webservice.
+#
+class ChangeStream(object):
+
+    def __init__(self, snapshotBuilder):
+        self.snapshot = snapshotBuilder.snapshot
+        self.clients = set()
+        snapshotBuilder.listeners.append(self.onPublish)
+
+    ## Called by the main loop with each published snapshot.
+    #
+    def onPublish(self, snapshot):
+        if snapshot.version != self.snapshot.version:
+            IOLoop.instance().add_callback(lambda: self.broadcast(snapshot))
+
+    def broadcast(self, snapshot):
+        if snapshot.version <= self.snapshot.version:
+            return
+        self.snapshot = snapshot
+        # the clients are usually up to date with the previous snapshot, the changes are only
+        # looked up once for each version the clients start from
+        changesBySince = {}
+        now = time.time()
+        for client in list(self.clients):
+            if client.flushStart is not None:
+                if now - client.flushStart > settings.CHANGE_STREAM_TIMEOUT:
+                    LOGGER.warning("disconnecting change stream client %s, its last batch has not been read for %.1fs",
+                                   client.request.remote_ip, now - client.flushStart)
+                    client.disconnect()
+                continue
+            if client.version not in changesBySince:
+                changesBySince[client.version] = self.getChanges(snapshot, client.version)
+            try:
+                client.push(snapshot, changesBySince[client.version])
+            except Exception:
+                LOGGER.exception("error while pushing changes to %s", client.request.remote_ip)
+                client.disconnect()
+
+    ## Returns a dict of object type -> (entries, removed keys) of the changes since the given
+    #  version, or None if they are not known.
+    #
+    def getChanges(self, snapshot, since):
+        changes = {}
+        for key, name in TYPES:
+            changes[key] = snapshot.changesSince(name, since)
+            if changes[key] is None:
+                return None
+        return changes
+
+
+class ChangeStreamResource(BaseResource):
+    ## Streams the changes of the model as server-sent events.
+    #
+    # The stream starts from the version of the model given by the since argument or the
+    # Last-Event-ID header, or from the current version. The events are:
+    # - version: the version the stream starts from, when it does not start with changes
+    # - changes: the objects created or changed and the keys of the removed objects, by type
+    # - resync: the changes are not known or too large, the objects must be fetched again
+    # The objects can be filtered with the types (a comma separated list), pool, user and node arguments.
+    #
+    @asynchronous
+    def get(self):
+        types = self.get_argument('types', None)
+        if types is not None:
+            types = [key for key in types.split(',') if key]
+            unknown = set(types).difference(key for key, name in TYPES)
+            if unknown:
+                raise Http400("Unknown object types %s" % ', '.join(sorted(unknown)))
+        node = self.get_argument('node', None)
+        if node is not None:
+            try:
+                node = int(node)
+            except ValueError:
+                raise Http400("Invalid node argument %r, expected a node id" % node)
+        self.filter = ChangeFilter(types, self.get_argument('pool', None), self.get_argument('user', None), node)
+        since = self.getSince()
+        if since is None and self.request.headers.get('Last-Event-ID'):
+            try:
+                since = int(self.request.headers['Last-Event-ID'])
+            except ValueError:
+                pass
+        self.stream = self.application.changeStream
+        snapshot = self.stream.snapshot
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self.flushStart = None
+        self.version = since if since is not None else snapshot.version
+        if self.version == snapshot.version or not self.push(snapshot, self.stream.getChanges(snapshot, self.version)):
+            self.send('version', snapshot.version, json.dumps({'version': snapshot.version}))
+        self.stream.clients.add(self)
+
+    ## Sends the changes from the version of the client to the given snapshot, returns False
+    #  if none of them is selected by the filter of the client.
+    #
+    def push(self, snapshot, changes):
+        since, self.version = self.version, snapshot.version
+        if changes is None:
+            self.sendResync(since)
+            return True
+        parts = ['"version": %d' % snapshot.version, '"since": %d' % since]
+        removed = {}
+        found = False
+        for key, name in TYPES:
+            if key not in self.filter.types:
+                continue
+            entries, removed[key] = changes[key]
+            entries = [entry for entry in entries if self.filter.accepts(snapshot, key, entry.data)]
+            if entries or removed[key]:
+                found = True
+            parts.append('"%s": %s' % (key, joinEncoded(entry.encoded for entry in entries)))
+        if not found:
+            return False
+        parts.append('"removed": %s' % json.dumps(removed))
+        data = '{%s}' % ', '.join(parts)
+        if len(data) > settings.CHANGE_STREAM_BUFFER_SIZE:
+            self.sendResync(since)
+        else:
+            self.send('changes', snapshot.version, data)
+        return True
+
+    def sendResync(self, since):
+        self.send('resync', self.version, json.dumps({'version': self.version, 'since': since}))
+
+    def send(self, event, version, data):
+        self.write('event: %s\nid: %d\ndata: %s\n\n' % (event, version, data))
+        self.flushStart = time.time()
+        self.flush(callback=self.onFlushed)
+
+    def onFlushed(self):
+        self.flushStart = None
+        # sends the changes published while the last batch was written
+        snapshot = self.stream.snapshot
+        if self in self.stream.clients and snapshot.version > self.version:
+            self.push(snapshot, self.stream.getChanges(snapshot, self.version))
+
+    def disconnect(self):
+        self.stream.clients.discard(self)
+        self.request.connection.stream.close()
+
+    def on_connection_close(self):
+        self.stream.clients.discard(self)
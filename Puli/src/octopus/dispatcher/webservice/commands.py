@@ -1,10 +1,5 @@
 
 
-try:
-    import simplejson as json
-except ImportError:
-    import json
-
 from octopus.core.enums.command import *
 from octopus.core.framework import BaseResource, queue
 from octopus.core.communication.http import Http404, Http400
@@ -16,22 +11,20 @@ ALLOWED_STATUS_VALUES = (CMD_READY, CMD_DONE, CMD_CANCELED)
 
 class CommandsResource(BaseResource):
     def get(self):
-        commands = self.framework.application.dispatchTree.commands.values()
-        commandRepresentations = [command.to_json() for command in commands]
-        commandRepresentations = json.dumps(commandRepresentations)
-        self.writeCallback(commandRepresentations)
+        snapshot = self.getSnapshot()
+        since = self.getSince()
+        if since is not None:
+            self.writeCallback(snapshot.encodedChanges('commands', 'commands', since))
+        else:
+            self.writeCallback(snapshot.commands.encodedValues())
 
 
 class CommandResource(BaseResource):
-    @queue
     def get(self, commandId):
-        try:
-            id = int(commandId)
-            command = self._findCommand(id)
-            rep = command.to_json()
-        except KeyError:
-            return Http404("No such command. Command with id %d not found." % id)
-        body = json.dumps(rep)
+        id = int(commandId)
+        body = self.getSnapshot().commands.getEncoded(id)
+        if body is None:
+            raise Http404("No such command. Command with id %d not found." % id)
         self.writeCallback(body)
 
     @queue
@@ -4,6 +4,11 @@ Created on Apr 27, 2012
 @author: Arnaud Chassagne
 '''
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 from octopus.core.framework import ResourceNotFoundError, BaseResource, queue
 from tornado.httpclient import HTTPError
 
@@ -11,7 +16,11 @@ from tornado.httpclient import HTTPError
 class LicensesResource(BaseResource):
     @queue
     def get(self):
-        self.writeCallback(repr(self.dispatcher.licenseManager))
+        if self.get_argument('counters', None):
+            # usage and contention counters of each license
+            self.writeCallback(json.dumps(self.dispatcher.licenseManager.getCounters()))
+        else:
+            self.writeCallback(repr(self.dispatcher.licenseManager))
 
 
 class LicenseResource(BaseResource):
@@ -20,8 +29,8 @@ class LicenseResource(BaseResource):
         try:
             lic = self.dispatcher.licenseManager.licenses[licenseName]
             licenseRepr = "{'max':%s, 'used':%s, 'rns':[" % (str(lic.maximum), str(lic.used))
-            for rn in sorted(lic.currentUsingRenderNodes):
-                licenseRepr += "\"%s\"," % rn.name
+            for rnName in sorted(rn.name for rn in lic.currentUsingRenderNodes):
+                licenseRepr += "\"%s\"," % rnName
             licenseRepr += "]}"
             self.writeCallback(licenseRepr)
         except KeyError:
@@ -47,6 +56,8 @@ class LicenseResource(BaseResource):
             return HTTPError(404, "Missing entry : 'rns'")
         else:
             rnsList = rns.split(",")
-            for rn in rnsList:
+            for rnName in rnsList:
+                # the holders of the licenses are the rendernodes themselves
+                rn = self.dispatcher.dispatchTree.renderNodes.get(rnName, rnName)
                 self.dispatcher.licenseManager.releaseLicenseForRenderNode(licenseName, rn)
             self.writeCallback("OK")
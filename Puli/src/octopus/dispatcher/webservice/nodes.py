@@ -48,21 +48,35 @@ if __name__ == '__main__':
 
 
 class NodesResource(BaseResource):
-    @queue
     def get(self):
         self.writeCallback(self.getNode(0))
 
     def getNode(self, nodeId):
         '''
-        Builds the representation for the given node.
+        Builds the representation for the given node from the last snapshot of the model, or the
+        representations of the nodes of its subtree changed since the version given by the since
+        argument of the request.
         '''
-        try:
-            node = self._findNode(nodeId)
-        except NodeNotFoundError, e:
-            return Http404("Node not found. %s" % str(e))
-        data = json.dumps(node.to_json())
+        snapshot = self.getSnapshot()
+        nodeId = int(nodeId)
+        data = snapshot.nodes.getEncoded(nodeId)
+        if data is None:
+            raise Http404("Node not found. %s" % nodeId)
+        since = self.getSince()
+        if since is not None:
+            accept = None
+            if nodeId != 0:
+                accept = lambda node: self._isInSubtree(snapshot, node, nodeId)
+            data = snapshot.encodedChanges('nodes', 'nodes', since, accept)
         return data
 
+    def _isInSubtree(self, snapshot, node, rootId):
+        while node is not None:
+            if node['id'] == rootId:
+                return True
+            node = snapshot.nodes.get(node['parent'])
+        return False
+
     def _findNode(self, nodeId):
         try:
             return self.getDispatchTree().nodes[int(nodeId)]
@@ -71,7 +85,6 @@ class NodesResource(BaseResource):
 
 
 class NodeResource(NodesResource):
-    @queue
     def get(self, nodeId):
         self.writeCallback(self.getNode(nodeId))
 
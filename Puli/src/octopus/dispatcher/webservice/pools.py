@@ -16,23 +16,20 @@ logger = logging.getLogger('dispatcher.webservice.PoolController')
 
 
 class PoolsResource(BaseResource):
-    @queue
     def get(self):
-        pools = self.getDispatchTree().pools.values()
+        pools = self.getSnapshot().pools.values()
         self.writeCallback({
-            'pools': dict(((pool.name, pool.to_json()) for pool in pools))
+            'pools': dict(((pool['name'], pool) for pool in pools))
         })
 
 
 class PoolResource(BaseResource):
-    @queue
     def get(self, poolName):
-        try:
-            pool = self.getDispatchTree().pools[poolName]
-        except KeyError:
-            return Http404('No such pool')
+        pool = self.getSnapshot().pools.get(poolName)
+        if pool is None:
+            raise Http404('No such pool')
         self.writeCallback({
-            'pool': pool.to_json()
+            'pool': pool
         })
 
     @queue
@@ -19,15 +19,18 @@ logger = logging.getLogger("dispatcher")
 
 
 class RenderNodesResource(BaseResource):
-    ## Lists the render nodes known by the dispatcher.
+    ## Lists the render nodes known by the dispatcher, or the ones created, changed or removed since
+    #  the version of the model given by the since argument.
     #
     # @param request the HTTP request
     #
-    @queue
     def get(self):
-        rendernodes = self.getDispatchTree().renderNodes.values()
-        content = {'rendernodes': list(rendernode.to_json() for rendernode in rendernodes)}
-        content = json.dumps(content)
+        snapshot = self.getSnapshot()
+        since = self.getSince()
+        if since is not None:
+            content = snapshot.encodedChanges('renderNodes', 'rendernodes', since)
+        else:
+            content = '{"rendernodes": %s}' % snapshot.renderNodes.encodedValues()
         self.writeCallback(content)
 
 
@@ -37,15 +40,11 @@ class RenderNodeResource(BaseResource):
     # @param request the HTTP request object for this request
     # @param computerName the name of the requested render node
     #
-    @queue
     def get(self, computerName):
         computerName = computerName.lower()
-        try:
-            rendernode = self.getDispatchTree().renderNodes[computerName]
-        except KeyError:
-            return Http404("RenderNode not found")
-        content = rendernode.to_json()
-        content = json.dumps(content)
+        content = self.getSnapshot().renderNodes.getEncoded(computerName)
+        if content is None:
+            raise Http404("RenderNode not found")
         self.writeCallback(content)
 
     @queue
@@ -59,8 +58,11 @@ class RenderNodeResource(BaseResource):
             if 'commands' in dct:
                 for cmdId in dct['commands']:
                     self.getDispatchTree().renderNodes[computerName].commands[cmdId] = self.getDispatchTree().commands[cmdId]
+                self.getDispatchTree().renderNodes[computerName].updateAvailability()
             if 'status' in dct:
                 self.getDispatchTree().renderNodes[computerName].status = int(dct['status'])
+            # the worker may have been restarted with another version
+            self.getDispatchTree().renderNodes[computerName].supportsBatchAssignment = True
             return HttpResponse(304, "RenderNode already registered.")
         else:
             for key in ('name', 'port', 'status', 'cores', 'speed', 'ram', 'pools', 'caracteristics'):
@@ -220,6 +222,8 @@ class RenderNodeSysInfosResource(BaseResource):
             renderNode.speed = float(dct["speed"])
         if "performance" in dct:
             renderNode.performance = float(dct["performance"])
+        if "ramInUse" in dct:
+            renderNode.setRamInUse(dct["ramInUse"])
         if "status" in dct:
             if renderNode.status == RN_UNKNOWN:
                 # if int(dct["status"]) == RN_PAUSED:
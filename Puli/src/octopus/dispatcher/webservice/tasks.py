@@ -29,12 +29,13 @@ class TaskNotFoundError(ResourceNotFoundError):
 
 
 class TasksResource(BaseResource):
-    @queue
     def get(self):
-        tasks = self.getDispatchTree().tasks
-        tasks = [task.to_json() for task in tasks.values()]
-        data = {'tasks': tasks}
-        body = json.dumps(data)
+        snapshot = self.getSnapshot()
+        since = self.getSince()
+        if since is not None:
+            body = snapshot.encodedChanges('tasks', 'tasks', since)
+        else:
+            body = '{"tasks": %s}' % snapshot.tasks.encodedValues()
         self.writeCallback(body)
 
 
@@ -64,12 +65,12 @@ class DeleteTasksResource(BaseResource):
 
 
 class TaskResource(BaseResource):
-    @queue
     def get(self, taskID):
         taskID = int(taskID)
-        task = self._findTask(taskID)
-        odict = {'tasks': [task.to_json()]}
-        body = json.dumps(odict)
+        task = self.getSnapshot().tasks.getEncoded(taskID)
+        if task is None:
+            raise HTTPError(404, "Task not found. No such task %d" % taskID)
+        body = '{"tasks": [%s]}' % task
         self.writeCallback(body)
 
     def _findTask(self, taskId):
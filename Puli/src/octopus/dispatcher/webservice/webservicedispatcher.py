@@ -10,7 +10,7 @@ from tornado.web import Application
 import tornado.web as web
 from tornado.httpserver import HTTPServer
 from octopus.dispatcher.webservice import commands, rendernodes, graphs, nodes,\
-    tasks, poolshares, pools, licenses
+    tasks, poolshares, pools, licenses, changes
 from octopus.core.enums.command import *
 from octopus.core.framework import BaseResource
 
@@ -21,6 +21,9 @@ class WebServiceDispatcher(Application):
     def __init__(self, framework, port):
         super(WebServiceDispatcher, self).__init__([
             (r'/stats/?$', StatsResource, dict(framework=framework)),
+            (r'/stats/cycle/?$', CycleStatsResource, dict(framework=framework)),
+
+            (r'/changes/?$', changes.ChangeStreamResource, dict(framework=framework)),
 
             (r'/licenses/?$', licenses.LicensesResource, dict(framework=framework)),
             (r'/licenses/([\w.-]+)/?$', licenses.LicenseResource, dict(framework=framework)),
@@ -73,6 +76,8 @@ class WebServiceDispatcher(Application):
             (r'^/system/?$', SystemResource, dict(framework=framework)),
             (r'^/mobile/?$', MobileResource, dict(framework=framework)),
         ])
+        # pushes the changes of the snapshots published by the main loop to the /changes clients
+        self.changeStream = changes.ChangeStream(framework.application.snapshotBuilder)
         self.listen(port, "0.0.0.0")
         self.framework = framework
 
@@ -102,11 +107,18 @@ class StatsResource(BaseResource):
             'commands': commandsByStatus,
             'rendernodes': renderNodeStats,
             'jobs': {'total': len([t for t in tree.tasks.values() if t.parent is None])},
-            'licenses': repr(self.dispatcher.licenseManager)
+            'licenses': repr(self.dispatcher.licenseManager),
+            'cycles': self.dispatcher.cycleStats.summary()
         }
         self.writeCallback(stats)
 
 
+class CycleStatsResource(BaseResource):
+    def get(self):
+        '''Returns the percentiles of the durations of the phases of the last dispatch cycles.'''
+        self.writeCallback(self.dispatcher.cycleStats.to_json())
+
+
 class MobileResource(BaseResource):
     def get(self):
         from octopus.core.enums.rendernode import RN_STATUS_NAMES
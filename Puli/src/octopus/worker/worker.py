@@ -5,6 +5,7 @@ import signal
 import sys
 import time
 import platform
+import subprocess
 try:
     import simplejson as json
 except ImportError:
@@ -106,6 +107,13 @@ class Worker(MainLoopApplication):
                 pass
         return int(memTotal) / 1024
 
+    def getRamInUse(self):
+        process = subprocess.Popen("ps -e -o rss | awk '{sum+=$1} END {print sum/1024}'",
+                                   shell=True,
+                                   stdout=subprocess.PIPE)
+        stdout_list = process.communicate()[0].split('\n')
+        return float(stdout_list[0])
+
     def getCpuInfo(self):
         if os.path.isfile('/proc/cpuinfo'):
             try:
@@ -427,6 +435,11 @@ class Worker(MainLoopApplication):
         #infos = self.fetchSysInfos()
         infos = {}
         infos['status'] = self.status
+        # report the ram in use so that the dispatcher does not have to ask for it
+        try:
+            infos['ramInUse'] = self.getRamInUse()
+        except (OSError, ValueError):
+            LOGGER.exception('Could not compute the ram in use')
         dct = json.dumps(infos)
         headers = {}
         headers['content-length'] = len(dct)
@@ -454,7 +467,9 @@ class Worker(MainLoopApplication):
         del self.commands[commandWatcher.commandId]
         try:
             os.remove(commandWatcher.processObj.pidfile)
-            self.status = rendernode.RN_IDLE
+            # other commands may still be running
+            if not self.commandWatchers:
+                self.status = rendernode.RN_IDLE
         except OSError, e:
             from errno import ENOENT
             err, msg = e.args
@@ -487,6 +502,14 @@ class Worker(MainLoopApplication):
             self.addCommandWatcher(newCommand)
             LOGGER.info("Added command %d {runner: %s, arguments: %s}", commandId, runner, repr(arguments))
 
+    ## Adds the commands of a batch assignment in a single order.
+    #
+    # @param commands a list of dicts with the keyword arguments of addCommandApply
+    #
+    def addCommandsApply(self, ticket, commands):
+        for command in commands:
+            self.addCommandApply(ticket, **command)
+
     ##
     #
     # @param id the integer value identifying the command
@@ -5,7 +5,6 @@ try:
 except ImportError:
     import json
 import logging
-import subprocess
 
 from octopus.core.communication.http import Http400, Http404
 from octopus.worker import settings
@@ -13,6 +12,7 @@ from tornado.web import Application, RequestHandler
 
 # /commands/ [GET] { commands: [ { id, status, completion } ] }
 # /commands/ [POST] { id, jobtype, arguments }
+# /commands/batch/ [POST] { commands: [ { id, jobtype, arguments } ] } -> { commands: [ { id, status } ] }
 # /commands/{id}/ [GET] { id, status, completion, jobtype, arguments }
 # /commands/{id}/ [DELETE] stops the job
 # /online/ [GET] { online }
@@ -27,6 +27,7 @@ class WorkerWebService(Application):
     def __init__(self, framework, port):
         super(WorkerWebService, self).__init__([
             (r'/commands/?$', CommandsResource, dict(framework=framework)),
+            (r'/commands/batch/?$', CommandsBatchResource, dict(framework=framework)),
             (r'/commands/(?P<id>\d+)/?$', CommandResource, dict(framework=framework)),
             (r'/debug/?$', DebugResource, dict(framework=framework)),
             (r'/log/?$', WorkerLogResource),
@@ -83,11 +84,7 @@ class PauseResource(BaseResource):
 
 class RamInUseResource(BaseResource):
     def get(self):
-        process = subprocess.Popen("ps -e -o rss | awk '{sum+=$1} END {print sum/1024}'",
-                                   shell=True,
-                                   stdout=subprocess.PIPE)
-        stdout_list = process.communicate()[0].split('\n')
-        self.write(stdout_list[0])
+        self.write(str(self.framework.application.getRamInUse()))
 
 
 class CommandsResource(BaseResource):
@@ -114,6 +111,49 @@ class CommandsResource(BaseResource):
         self.set_status(202)
 
 
+class CommandsBatchResource(BaseResource):
+    COMMAND_KEYS = ('id', 'runner', 'arguments', 'validationExpression', 'taskName', 'relativePathToLogDir', 'environment')
+
+    def post(self):
+        '''Adds several commands at once.
+
+        The whole batch is checked before any command is added: if one of the commands is
+        invalid, the request is rejected. The commands are then added in a single order and
+        the status of each of them is returned.
+        '''
+        self.setRnId(self.request)
+        data = self.getBodyAsJSON()
+        if not isinstance(data, dict) or not isinstance(data.get('commands'), list):
+            raise Http400("The HTTP body must be a JSON object with a list of commands")
+        commands = []
+        for command in data['commands']:
+            if not isinstance(command, dict) or not all(key in command for key in self.COMMAND_KEYS):
+                raise Http400("Invalid command in batch: %r" % (command,))
+            dct = dict((str(key), command[key]) for key in self.COMMAND_KEYS)
+            try:
+                dct['commandId'] = int(dct.pop('id'))
+            except (TypeError, ValueError):
+                raise Http400("Invalid command id in batch: %r" % (command['id'],))
+            commands.append(dct)
+
+        application = self.framework.application
+        results = []
+        if application.isPaused:
+            results = [{'id': dct['commandId'], 'status': 'paused'} for dct in commands]
+        else:
+            newCommands = []
+            for dct in commands:
+                if dct['commandId'] in application.commands:
+                    results.append({'id': dct['commandId'], 'status': 'running'})
+                else:
+                    results.append({'id': dct['commandId'], 'status': 'accepted'})
+                    newCommands.append(dct)
+            if newCommands:
+                self.framework.addOrder(application.addCommandsApply, commands=newCommands)
+        self.set_status(202)
+        self.write({'commands': results})
+
+
 class CommandResource(BaseResource):
     def put(self, id):
         self.setRnId(self.request)